@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+# starts growing numbers of dht nodes in one process on loopback, each
+# joining through a node already running, announces a peer for a number
+# of clubs from random nodes, then looks the clubs up from other random
+# nodes one at a time. reports the time and messages each lookup took,
+# and how many found the peer announced
+
+from asyncio import new_event_loop, set_event_loop, gather
+from random import Random
+from time import perf_counter
+
+import dht
+
+
+async def run(n, clubs, lookups, port, rand):
+    nodes = [dht.Node(('127.0.0.1', port + i), rand.randbytes(32)) for i in range(n)]
+    await gather(*(node.start() for node in nodes))
+
+    try:
+        for i, node in enumerate(nodes[1:], 1):
+            await node.bootstrap([nodes[rand.randrange(i)].addr])
+
+        announced = {}
+        for _ in range(clubs):
+            club_id = rand.randbytes(32)
+            # nodes store the port at the address it came from
+            announced[club_id] = dht.encode_addr(('127.0.0.1', rand.randrange(1, 65536)))
+            await rand.choice(nodes).announce(club_id, [announced[club_id]])
+
+        times = []
+        messages = []
+        found = 0
+
+        for _ in range(lookups):
+            node = rand.choice(nodes)
+            club_id = rand.choice(list(announced))
+
+            sent = sum(x.sent for x in nodes)
+            start = perf_counter()
+            peers = await node.get_peers(club_id)
+            times.append(perf_counter() - start)
+            messages.append(sum(x.sent for x in nodes) - sent)
+            found += announced[club_id] in peers
+
+        times.sort()
+        table = sum(len(node.table) for node in nodes) / n
+
+        print("%5d nodes %5.1f table, lookup %6.2fms median %6.2fms p99, %5.1f messages, %d/%d found"%(
+            n, table, times[len(times)//2] * 1000, times[len(times)*99//100] * 1000,
+            sum(messages) / len(messages), found, lookups))
+    finally:
+        for node in nodes:
+            node.close()
+
+
+def main(max_nodes=512, clubs=32, lookups=200, port=11000, seed=0):
+    loop = new_event_loop()
+    set_event_loop(loop)
+    rand = Random(seed)
+
+    try:
+        n = 16
+        while n <= max_nodes:
+            loop.run_until_complete(run(n, clubs, lookups, port, rand))
+            n *= 2
+    finally:
+        loop.close()
+
+
+if __name__ == '__main__':
+    import sys
+    main(*(int(a) for a in sys.argv[1:]))
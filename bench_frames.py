@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+from struct import pack, unpack
+from random import Random
+from time import perf_counter
+import os
+
+from frame import FrameDecoder
+
+
+class OldDecoder:
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.buffer = b''
+        self.state = (2, self._decode_length)
+
+    def feed(self, data):
+        self.buffer += data
+
+        while len(self.buffer) >= self.state[0]:
+            n = self.state[0]
+            packet = self.buffer[:n]
+            self.buffer = self.buffer[n:]
+            self.state = self.state[1](packet)
+
+    def _decode_length(self, data):
+        n, = unpack('!H', data)
+        return (n, self._decode_body)
+
+    def _decode_body(self, data):
+        t, = unpack("!H", data[:2])
+        self.callback(t, data[2:])
+        return (2, self._decode_length)
+
+
+def frame(t, data):
+    return pack("!HH", len(data) + 2, t) + data
+
+
+def capture(objects, size):
+    chunks = []
+
+    for _ in range(objects):
+        chunks.append(frame(1, os.urandom(32)))
+
+    data = os.urandom(size)
+    for i in range(0, size, 1024):
+        chunks.append(frame(4 if i + 1024 < size else 5, data[i:i+1024]))
+
+    return b''.join(chunks)
+
+
+def segments(stream, seed, mss):
+    rand = Random(seed)
+    offset = 0
+
+    while offset < len(stream):
+        n = rand.randint(1, mss)
+        yield stream[offset:offset+n]
+        offset += n
+
+
+def run(cls, stream, seed, mss):
+    frames = 0
+    total = 0
+
+    def callback(t, data):
+        nonlocal frames, total
+        frames += 1
+        total += len(data)
+
+    decoder = cls(callback)
+    segs = list(segments(stream, seed, mss))
+
+    start = perf_counter()
+    for seg in segs:
+        decoder.feed(seg)
+    elapsed = perf_counter() - start
+
+    return elapsed, frames, total
+
+
+def main(size=16*1024*1024, mss=65536, seed=0):
+    stream = capture(10000, size)
+    print("stream: %d bytes, segments up to %d bytes"%(len(stream), mss))
+
+    results = [(cls.__name__, run(cls, stream, seed, mss)) for cls in (OldDecoder, FrameDecoder)]
+    assert results[0][1][1:] == results[1][1][1:]
+
+    for name, (elapsed, frames, total) in results:
+        print("%-12s %8.3fs %10.1f MB/s %d frames"%(name, elapsed, len(stream)/elapsed/1e6, frames))
+
+
+if __name__ == '__main__':
+    import sys
+    main(*(int(a) for a in sys.argv[1:]))
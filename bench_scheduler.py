@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+
+# simulates a random mesh where objects appear at random nodes and are
+# pulled from neighbours through scheduler.Scheduler, and compares the
+# policies on the time until every node has every object
+
+from collections import defaultdict
+from heapq import heappush, heappop
+from itertools import count
+from random import Random
+
+import scheduler
+
+
+class SimLoop:
+
+    def __init__(self):
+        self.now = 0.0
+        self.events = []
+        self.seq = count()
+
+    def time(self):
+        return self.now
+
+    def call_at(self, when, f, *args):
+        heappush(self.events, (when, next(self.seq), f, args))
+
+    def run(self):
+        while self.events:
+            self.now, _, f, args = heappop(self.events)
+            f(*args)
+
+
+class Link:
+
+    def __init__(self, bandwidth, latency):
+        self.bandwidth = bandwidth
+        self.latency = latency
+        self.busy = 0.0
+
+
+class SimConn:
+
+    def __init__(self, loop, node, peer, link, window):
+        self.node = node
+        self.peer = peer
+        self.link = link
+        self.window = window
+        self.requests = set()
+        self.stats = scheduler.LinkStats(loop)
+
+
+class SimNode:
+
+    def __init__(self, loop, policy):
+        self.loop = loop
+        self.conns = {}
+        self.objects = {}
+        self.done = {}
+
+        self.sha_to_conn = defaultdict(set)
+        self.conn_to_sha = defaultdict(set)
+        self.requesting = set()
+        self.sizes = {}
+        self.scheduler = scheduler.Scheduler(self, policy)
+
+    def add(self, sha, size):
+        self.objects[sha] = size
+        self.done[sha] = self.loop.now
+
+        for conn in self.conns.values():
+            back = conn.peer.conns[self]
+            self.loop.call_at(
+                self.loop.now + conn.link.latency,
+                conn.peer.new_object, sha, size, back)
+
+    def new_object(self, sha, size, conn):
+        if sha in self.objects or sha in self.conn_to_sha[conn]:
+            return
+
+        self.sha_to_conn[sha].add(conn)
+        self.conn_to_sha[conn].add(sha)
+        self.sizes[sha] = size
+        self.scheduler.announced(conn, sha)
+        self.fill(conn)
+
+    def fill(self, conn):
+        while len(conn.requests) < self.scheduler.window(conn):
+            sha = self.scheduler.next(conn)
+            if sha is None:
+                return
+
+            self.request(conn, sha)
+
+    def request(self, conn, sha):
+        conn.requests.add(sha)
+        self.requesting.add(sha)
+        conn.stats.request_sent(sha)
+
+        # the peer answers over the link back to us, one object at a time
+        now = self.loop.now
+        link = conn.peer.conns[self].link
+        size = self.sizes[sha]
+
+        start = max(now + conn.link.latency, link.busy)
+        link.busy = start + size / link.bandwidth
+
+        self.loop.call_at(start + link.latency, conn.stats.response, sha, 0)
+        self.loop.call_at(link.busy + link.latency, self.finish, conn, sha, size)
+
+    def finish(self, conn, sha, size):
+        conn.requests.remove(sha)
+        conn.stats.response(sha, size)
+        if not conn.requests:
+            conn.stats.idle()
+
+        self.requesting.remove(sha)
+        self.sizes.pop(sha)
+
+        holders = self.sha_to_conn.pop(sha)
+        for c in holders:
+            self.conn_to_sha[c].remove(sha)
+
+        self.scheduler.finished(sha, size)
+        self.add(sha, size)
+
+        for c in holders:
+            self.fill(c)
+
+
+def simulate(policy, nodes, degree, objects, window, seed):
+    rand = Random(seed)
+    loop = SimLoop()
+    mesh = [SimNode(loop, policy) for _ in range(nodes)]
+
+    def connect(a, b):
+        if a is b or b in a.conns:
+            return
+
+        latency = rand.uniform(0.005, 0.2)
+        for x, y in ((a, b), (b, a)):
+            link = Link(rand.choice((1e5, 1e6, 1e7)), latency)
+            x.conns[y] = SimConn(loop, x, y, link, window)
+
+    for i, node in enumerate(mesh):
+        connect(node, mesh[(i + 1) % nodes])
+        for _ in range(degree - 2):
+            connect(node, rand.choice(mesh))
+
+    created = {}
+    for i in range(objects):
+        sha = i.to_bytes(32, 'big')
+        size = int(min(rand.lognormvariate(9, 2), 5e7))
+        when = rand.uniform(0, 10)
+        created[sha] = when
+        loop.call_at(when, rand.choice(mesh).add, sha, size)
+
+    loop.run()
+
+    latest = max(max(n.done.values()) for n in mesh)
+    spread = [max(n.done[sha] for n in mesh) - t for sha, t in created.items()]
+    return latest, sum(spread) / len(spread)
+
+
+def main(nodes=30, degree=4, objects=300, window=16, seed=0):
+    print("%d nodes, degree %d, %d objects, window %d"%(nodes, degree, objects, window))
+
+    for policy in scheduler.POLICIES:
+        latest, mean = simulate(policy, nodes, degree, objects, window, seed)
+        print("%-10s full replication at %8.2fs, mean per object %8.2fs"%(policy, latest, mean))
+
+
+if __name__ == '__main__':
+    import sys
+    main(*(int(a) for a in sys.argv[1:]))
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+# ingests small objects the way a peer stores what it downloads, then
+# serves them in random order the way Connection.write_response reads
+# them, once with loose files and once with pack files
+
+from random import Random
+from time import perf_counter
+import hashlib
+import os
+import shutil
+import tempfile
+
+import packfile
+import store
+
+
+def make_objects(n, seed):
+    rand = Random(seed)
+    objects = []
+
+    for _ in range(n):
+        data = rand.randbytes(int(min(rand.lognormvariate(8, 1), packfile.PACK_OBJECT_SIZE)))
+        objects.append((hashlib.sha256(data).hexdigest(), data))
+
+    return objects
+
+
+def ingest(s, objects):
+    for name, data in objects:
+        s.add(name, data)
+
+
+def serve(s, names):
+    buf = bytearray(256 * 1024)
+    total = 0
+
+    with memoryview(buf) as view:
+        for name in names:
+            with s.open('cur', name) as f:
+                size = f.seek(0, os.SEEK_END)
+                f.seek(0)
+
+                while True:
+                    n = f.readinto(view[:size])
+                    if n == 0:
+                        break
+                    total += n
+
+    return total
+
+
+def run(name, setup, objects, seed):
+    path = tempfile.mkdtemp(prefix='bench_store.')
+
+    try:
+        setup(path)
+        s = packfile.open_store(path)
+
+        start = perf_counter()
+        ingest(s, objects)
+        ingested = perf_counter() - start
+
+        names = [n for n, _ in objects]
+        Random(seed).shuffle(names)
+
+        start = perf_counter()
+        total = serve(s, names)
+        served = perf_counter() - start
+
+        assert total == sum(len(d) for _, d in objects)
+        print("%-6s ingest %9.0f objects/s   serve %9.0f objects/s %8.1f MB/s"%(
+            name, len(objects)/ingested, len(objects)/served, total/served/1e6))
+    finally:
+        shutil.rmtree(path)
+
+
+def main(n=20000, seed=0):
+    objects = make_objects(n, seed)
+    size = sum(len(d) for _, d in objects)
+    print("%d objects, %.1f MB"%(n, size/1e6))
+
+    run('loose', store.Store, objects, seed)
+    run('packed', packfile.PackStore, objects, seed)
+
+
+if __name__ == '__main__':
+    import sys
+    main(*(int(a) for a in sys.argv[1:]))
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+# runs the tracker in a child process and announces to it from many
+# concurrent clients, each announcing a random address over a fresh
+# connection the way TcpTrackerClient does, and reports announces per
+# second. each announce is for one of a number of clubs. stalled clients
+# connect and never send anything, like peers on a bad link
+
+from asyncio import new_event_loop, set_event_loop, open_connection, sleep, gather
+from multiprocessing import Process
+from random import Random
+from struct import pack, error as struct_error
+from time import perf_counter
+
+import tracker
+
+
+def serve(port):
+    tracker.main(port)
+
+
+async def client(port, rand, clubs, deadline, counts):
+    while perf_counter() < deadline:
+        addr = pack("!4sH", rand.randbytes(4), rand.randrange(1, 65536))
+        club_id = rand.choice(clubs)
+
+        try:
+            reader, writer = await open_connection('127.0.0.1', port)
+        except OSError:
+            counts['errors'] += 1
+            await sleep(0.01)
+            continue
+
+        writer.write(tracker.encode_announce([(club_id, [addr])]))
+
+        try:
+            tracker.decode_response(await reader.read())
+            counts['announces'] += 1
+        except (OSError, ValueError, struct_error):
+            counts['errors'] += 1
+        finally:
+            writer.close()
+
+
+def main(clients=200, seconds=5, stalled=0, swarms=1, port=10900, seed=0):
+    server = Process(target=serve, args=(port,), daemon=True)
+    server.start()
+
+    loop = new_event_loop()
+    set_event_loop(loop)
+
+    try:
+        loop.run_until_complete(sleep(0.5))
+
+        idle = [
+            loop.run_until_complete(open_connection('127.0.0.1', port))
+            for _ in range(stalled)]
+
+        counts = {'announces': 0, 'errors': 0}
+        start = perf_counter()
+        deadline = start + seconds
+        rand = Random(seed)
+        clubs = [rand.randbytes(32) for _ in range(swarms)]
+
+        loop.run_until_complete(gather(*(
+            client(port, Random(rand.random()), clubs, deadline, counts)
+            for _ in range(clients))))
+
+        elapsed = perf_counter() - start
+        for _, writer in idle:
+            writer.close()
+
+        print("%d clients, %d swarms, %d announces in %.1fs, %.0f announces/s, %d errors"%(
+            clients, swarms, counts['announces'], elapsed,
+            counts['announces']/elapsed, counts['errors']))
+    finally:
+        loop.close()
+        server.terminate()
+
+
+if __name__ == '__main__':
+    import sys
+    main(*(int(a) for a in sys.argv[1:]))
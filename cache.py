@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+# a new object is usually requested by every peer within seconds of
+# arriving, so the contents of recent small objects are kept in memory
+# and served from there instead of the disk. least recently used
+# objects are dropped once the total size goes over the limit
+
+from collections import OrderedDict
+
+
+CACHE_SIZE = 64 * 1024 * 1024
+
+# larger objects are served by pieces, and would push out many small ones
+CACHE_OBJECT_SIZE = 256 * 1024
+
+
+class ObjectCache:
+
+    def __init__(self, size=CACHE_SIZE, object_size=CACHE_OBJECT_SIZE):
+        self.max_size = size
+        self.object_size = object_size
+        self.objects = OrderedDict()
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.served = 0
+
+    def __contains__(self, sha):
+        return sha in self.objects
+
+    def __len__(self):
+        return len(self.objects)
+
+    def get(self, sha):
+        data = self.objects.get(sha)
+
+        if data is None:
+            self.misses += 1
+            return None
+
+        self.objects.move_to_end(sha)
+        self.hits += 1
+        self.served += len(data)
+        return memoryview(data)
+
+    def peek(self, sha):
+        # without counting a hit or refreshing the entry
+        return self.objects.get(sha)
+
+    def add(self, sha, data):
+        if len(data) > self.object_size or sha in self.objects:
+            return
+
+        self.objects[sha] = data
+        self.size += len(data)
+
+        while self.size > self.max_size:
+            _, old = self.objects.popitem(last=False)
+            self.size -= len(old)
+            self.evictions += 1
+
+    def metrics(self):
+        requests = self.hits + self.misses
+        return {
+            'objects': len(self.objects),
+            'size': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / requests if requests else 0.0,
+            'evictions': self.evictions,
+            'served': self.served,
+        }
@@ -2,11 +2,15 @@
 
 # from errno import EADDRNOTAVAIL
 
-from struct import pack, unpack
+from struct import Struct, pack, unpack, unpack_from, error as struct_error
 from collections import deque, defaultdict
-from itertools import count
+from itertools import count, islice
+from functools import partial
+from random import uniform
+import hashlib
 import os
 import os.path
+import time
 
 from socket import (
     inet_aton, inet_ntoa,
@@ -16,14 +20,93 @@ from socket import (
     SOMAXCONN)
 
 from asyncio import (
-    get_event_loop, sleep, ensure_future,
-    open_connection, Protocol, Transport, Future)
+    get_event_loop, sleep, ensure_future, wait, wait_for,
+    open_connection, Protocol, Transport, Future, IncompleteReadError,
+    TimeoutError)
 
 from asyncio.sslproto import SSLProtocol
 
 import ssl
 
 import inotify
+from frame import FrameDecoder, encode_header
+import reconcile
+import swarm
+import scheduler
+import packfile
+import diskio
+import cache
+import known
+import peers
+import tracker
+import dht
+
+
+ALPN_PROTOCOL = 'blackout/2'
+
+FEATURE_LARGE_FRAMES = 0x1
+FEATURE_INVENTORY = 0x2
+FEATURE_RECONCILE = 0x4
+FEATURE_REQUEST_ID = 0x8
+FEATURE_SWARM = 0x10
+FEATURE_RESUME = 0x20
+FEATURE_SIZES = 0x40
+FEATURE_PUSH = 0x80
+FEATURE_PEX = 0x100
+
+FEATURES = (
+    FEATURE_LARGE_FRAMES | FEATURE_INVENTORY | FEATURE_RECONCILE |
+    FEATURE_REQUEST_ID | FEATURE_SWARM | FEATURE_RESUME | FEATURE_SIZES |
+    FEATURE_PUSH | FEATURE_PEX)
+
+ERROR_NOT_FOUND = 404
+ERROR_BAD_RANGE = 416
+
+# manifests kept for serving large objects
+MANIFEST_CACHE_SIZE = 64
+
+# chunks at least this large are hashed off the event loop
+HASH_THREAD_SIZE = 64 * 1024
+
+# a peer which sent this many corrupt objects is disconnected
+MAX_PENALTIES = 3
+
+# largest number of digests that fits in a 16-bit frame, without and
+# with sizes
+INVENTORY_SIZE = 2047
+INVENTORY_SIZED_SIZE = 1638
+
+# the object index is saved next to cur/ with the latest mtime in cur/
+# at the time, and only trusted at startup if cur/ has not changed since
+INDEX_MAGIC = b'blkidx01'
+INDEX_HEADER = Struct("!8sqQ")
+INDEX_INTERVAL = 60
+
+# objects up to this size are sent along with their announcement, which
+# saves the peer a round trip to request them
+PUSH_SIZE = 16 * 1024
+
+# new objects are announced together, once this many seconds have passed
+# since the first one, or once there are this many
+ANNOUNCE_DELAY = 0.005
+ANNOUNCE_BATCH = 1024
+
+# incoming connections beyond this many handshakes at once wait in a
+# queue, and are turned away when the queue is full, when they waited
+# too long, or when there are already too many connections
+MAX_HANDSHAKES = 8
+MAX_CONNECTIONS = 64
+ADMISSION_QUEUE = 128
+ADMISSION_TIMEOUT = 5
+HANDSHAKE_TIMEOUT = 10
+
+# seconds between keepalives of a tracker session, and the longest wait
+# between polls of a tracker when no session can be had
+KEEPALIVE = 20
+MAX_POLL_INTERVAL = 300
+
+# seconds to wait for the tracker to answer an announce or a keepalive
+TRACKER_TIMEOUT = 10
 
 
 class ProxyProtocol(Protocol):
@@ -63,6 +146,8 @@ def create_tls_context():
         keyfile=os.path.join(ROOT,"peer.key"))
     context.load_verify_locations(
         os.path.join(ROOT,"ca.crt"))
+    # peers which do not offer this speak the original protocol
+    context.set_alpn_protocols([ALPN_PROTOCOL])
     return context
 
 
@@ -84,7 +169,7 @@ class PeerSSLProtocol(Protocol):
 
         self.connected = Future()
         self.hello_received = Future()
-        ensure_future(self.init_connection(loop, connection))
+        self.task = ensure_future(self.init_connection(loop, connection))
 
     async def init_connection(self, loop, connection):
         waiter = Future()
@@ -101,7 +186,13 @@ class PeerSSLProtocol(Protocol):
         transport = await self.connected
         transport.write(out_data)
 
-        await self.hello_received
+        try:
+            await self.hello_received
+        except ConnectionError:
+            connection.endpoint.remove(connection)
+            connection.endpoint.peers.failed(connection.addr)
+            return
+
         peer_random = self.buffer[15:43]
 
         if my_random == peer_random:
@@ -127,13 +218,19 @@ class PeerSSLProtocol(Protocol):
         try:
             await waiter
         except:
-            connection.endpoint.connections.pop(connection.addr)
+            connection.endpoint.remove(connection)
+            connection.endpoint.peers.failed(connection.addr)
             raise
 
 
     def connection_made(self, transport):
         self.connected.set_result(transport)
 
+    def connection_lost(self, exc):
+        # closed before the handshake got going, turned away by the peer
+        if not self.hello_received.done():
+            self.hello_received.set_exception(ConnectionResetError())
+
 
     def data_received(self, data):
         self.buffer = self.buffer + data
@@ -151,123 +248,718 @@ class PeerSSLProtocol(Protocol):
 
 
 
+def _hash_file(h, path, size):
+    with open(path, 'rb') as f:
+        while size > 0:
+            data = f.read(min(size, 1024 * 1024))
+            if not data:
+                return
+
+            h.update(data)
+            size -= len(data)
+
+
+class Hasher:
+
+    def __init__(self, loop=None):
+        if loop is None:
+            loop = get_event_loop()
+
+        self.loop = loop
+        self.hash = hashlib.sha256()
+        self.queue = deque()
+        self.task = None
+
+    def _submit(self, f, after=None):
+        self.queue.append((f, after))
+
+        if self.task is None:
+            self.task = ensure_future(self._run())
+
+    async def _run(self):
+        # one job at a time, so updates stay in order
+        while self.queue:
+            f, after = self.queue.popleft()
+            if after is not None:
+                await after.drain()
+
+            await self.loop.run_in_executor(None, f)
+
+        self.task = None
+
+    def update(self, data):
+        if self.task is None and len(data) < HASH_THREAD_SIZE:
+            self.hash.update(data)
+        else:
+            self._submit(partial(self.hash.update, bytes(data)))
+
+    def update_file(self, path, size, after=None):
+        # after, a File whose writes must reach the disk first
+        self._submit(partial(_hash_file, self.hash, path, size), after)
+
+    async def digest(self):
+        while self.task is not None:
+            await self.task
+
+        return self.hash.digest()
+
+
 class ObjectRequest:
 
-    def __init__(self, club, conn, sha):
+    def __init__(self, club, conn, sha, id, resume=False):
         self.club = club
         self.conn = conn
         self.sha = sha
-        self.f = club.tempfile(sha)
+        self.id = id
+
+        # left by an earlier attempt, continued from its end if the
+        # peer can resume, otherwise overwritten
+        self.partial = club.partials.get(sha, 0)
+        self.offset = self.partial if resume else 0
+        self.size = None
+
+        # a small object is kept in memory and stored from there, for the
+        # cache and so it can go into a pack without a file in tmp/. it
+        # is only written to tmp/ once it grows too large, or to keep
+        # what arrived when the request fails
+        self.data = None if self.offset else bytearray()
+        self.file = None
+
+        self.hasher = Hasher()
+        if self.offset:
+            previous = self._open_file()
+            self.hasher.update_file(self.file.path, self.offset, previous)
+
+    def _open_file(self):
+        # the partial counts what an earlier attempt queued, which is only
+        # on the disk once its file has run every job
+        previous = self.club.files.get(self.sha)
+        self.file = diskio.File(self.club.storage, self.club.store.tmp_path(self.sha.hex()), previous)
+        self.club.files[self.sha] = self.file
+        self.file.open()
+        return previous
+
+    def _spill(self):
+        self._open_file()
+        self.file.truncate(0)
+        self.file.write(self.data)
+        self.data = None
 
     def write(self, data):
-        self.f.write(data)
+        if self.size is None:
+            self.size = self.offset
+            if self.file is not None:
+                self.file.truncate(self.offset)
+
+        self.size += len(data)
+        self.hasher.update(data)
+
+        if self.data is None:
+            self.file.write(data)
+            return
+
+        self.data += data
+        if len(self.data) > packfile.PACK_OBJECT_SIZE:
+            self._spill()
 
     def finish(self):
-        self.f.close()
-        self.conn.request = None
+        del self.conn.requests[self.id]
+
+        if self.file is None:
+            self.club.verify_data(self.sha, self.conn, self.hasher, self.data)
+        else:
+            self.club.verify_object(self.sha, self.conn, self.hasher, self.file, self.offset)
 
-        # if sha does not match
-        #   self.fail()
-        # else
+    def fail(self, code=None):
+        del self.conn.requests[self.id]
 
-        self.club.finish_object(self.sha, self.conn)
+        if self.file is None:
+            if self.data:
+                self._spill()
+            else:
+                self.club.fail_object(self.sha, self.conn)
+                return
+
+        if code != ERROR_BAD_RANGE:
+            self.file.close_soon()
+            self.club.partials[self.sha] = self.partial if self.size is None else self.size
+            self.club.fail_object(self.sha, self.conn)
+            return
 
-    def fail(self):
-        self.f.close()
-        self.conn.request = None
+        # the partial is longer than the object, start over
+        self.file.truncate(0)
+        self.file.close_soon()
+        self.club.partials[self.sha] = 0
+        self.club.retry_object(self.sha, self.conn)
+
+    def manifest(self, data):
+        del self.conn.requests[self.id]
+
+        try:
+            size, hashes = swarm.decode_manifest(data)
+        except ValueError:
+            if self.file is not None:
+                self.file.close_soon()
+            self.club.fail_object(self.sha, self.conn)
+            return
+
+        if self.file is None:
+            self._open_file()
+
+        ensure_future(self._download(size, hashes))
+
+    def _check_pieces(self, size, hashes):
+        return swarm.check_pieces(self.file.f, size, hashes)
+
+    async def _download(self, size, hashes):
+        # the download takes the file over once the pieces an earlier
+        # attempt left in it are checked
+        try:
+            missing = await self.file.run(self._check_pieces, size, hashes)
+        except OSError:
+            self.file.close_soon()
+            self.club.fail_object(self.sha, self.conn)
+            return
 
-        self.club.fail_object(self.sha, self.conn)
+        self.club.start_download(self.sha, size, hashes, self.file, missing, self.conn)
 
 
 class Club:
 
-    def __init__(self, path, monitor):
+    def __init__(self, path, monitor, policy='rarest',
+                 announce_delay=ANNOUNCE_DELAY, announce_batch=ANNOUNCE_BATCH,
+                 club_id=tracker.DEFAULT_CLUB):
         self.path = path
+        self.id = club_id
+        self.monitor = monitor
         self.endpoints = set()
 
         self.sha_to_conn = defaultdict(lambda: set())
         self.conn_to_sha = defaultdict(lambda: set())
 
         self.requesting = set()
+        self.sizes = {}
+        self.scheduler = scheduler.Scheduler(self, policy)
+        self.downloads = {}
+        self.manifests = {}
+        self.penalties = defaultdict(int)
+
+        # objects waiting to be announced with their size, None for those
+        # found in cur/ which still need a look at the disk
+        self.to_announce = {}
+        self.announce_delay = announce_delay
+        self.announce_batch = announce_batch
+        self.announce_handle = None
+        self.announcing = None
+
+        # announcements sent, and those skipped as the peer knew already
+        self.announced = 0
+        self.suppressed = 0
+
+        self.store = packfile.open_store(path)
+        self.storage = diskio.Storage()
+        self.cache = cache.ObjectCache()
+        self.partials = self._scan_partials()
+        self.files = {}
+        self.store.watch(monitor, 'cur', inotify.IN_CREATE, self.on_new_object)
+
+        self.objects = self._load_index()
+        self.saved = 0
+        if self.objects is None:
+            self.objects = reconcile.ObjectSet(self._scan_objects())
+            self.saved = None
+
+        create_periodic_task(self.save_index, INDEX_INTERVAL, INDEX_INTERVAL)
 
-        os.makedirs(os.path.join(path, 'cur'), exist_ok=True)
-        os.makedirs(os.path.join(path, 'new'), exist_ok=True)
-        os.makedirs(os.path.join(path, 'tmp'), exist_ok=True)
+    def on_new_object(self, event):
+        # objects moved by a store migration are already known
+        sha = bytes.fromhex(event.name)
+        if self.objects.add(sha):
+            self.announce(sha)
 
-        monitor.register(os.path.join(path, 'cur'), inotify.IN_CREATE, self.on_new_object)
+    def announce(self, sha, size=None):
+        self.to_announce[sha] = size
 
-    def on_new_object(self, event):
-        for e in self.endpoints:
-            for c in e.connections.values():
-                ensure_future(c._protocol._app_protocol.write_object(bytes.fromhex(event.name)))
+        if self.announcing is not None:
+            return
 
-    def _cur_path(self, filename):
-        return os.path.join(self.path, 'cur', filename)
+        if len(self.to_announce) >= self.announce_batch:
+            if self.announce_handle is not None:
+                self.announce_handle.cancel()
+                self.announce_handle = None
+            self.announcing = ensure_future(self._announce())
+        elif self.announce_handle is None:
+            loop = get_event_loop()
+            self.announce_handle = loop.call_later(self.announce_delay, self._start_announce)
+
+    def _start_announce(self):
+        self.announce_handle = None
+        self.announcing = ensure_future(self._announce())
+
+    async def _announce(self):
+        # one batch at a time, objects arriving meanwhile make up the next
+        while self.to_announce:
+            batch = self.to_announce
+            self.to_announce = {}
+
+            new = [sha for sha, size in batch.items() if size is None]
+            if new:
+                try:
+                    found = await self.storage.run(self._read_new, new)
+                except OSError:
+                    found = {}
+
+                for sha, (size, data) in found.items():
+                    batch[sha] = size
+                    if data is not None:
+                        self.cache.add(sha, data)
+
+            objects = [
+                (sha, size or 0, self.cache.peek(sha))
+                for sha, size in batch.items()]
+            self._announce_batch(objects)
+
+        self.announcing = None
+
+    def _read_new(self, shas):
+        # objects from smtp.py are about to be requested by every peer, so
+        # small ones are cached before the announcement, which can then
+        # push them
+        found = {}
+
+        for sha in shas:
+            try:
+                with self.store.open('cur', sha.hex()) as f:
+                    data = f.read(self.cache.object_size + 1)
+                    size = f.seek(0, os.SEEK_END)
+            except FileNotFoundError:
+                continue
 
-    def _new_path(self, filename):
-        return os.path.join(self.path, 'new', filename)
+            found[sha] = size, data if len(data) == size else None
 
-    def _tmp_path(self, filename):
-        return os.path.join(self.path, 'tmp', filename)
+        return found
 
-    def tempfile(self, sha):
-        return open(self._tmp_path(sha.hex()), 'xb')
+    def _announce_batch(self, objects):
+        for e in self.endpoints:
+            for conn in e.connections.values():
+                # still in the handshake
+                if conn.transport is None:
+                    continue
+
+                unknown = [o for o in objects if o[0] not in conn.known]
+
+                self.announced += len(unknown)
+                self.suppressed += len(objects) - len(unknown)
+
+                if unknown:
+                    conn.announce(unknown)
+
+    def metrics(self):
+        total = self.announced + self.suppressed
+        return {
+            'announced': self.announced,
+            'suppressed': self.suppressed,
+            'suppression': self.suppressed / total if total else 0.0,
+            'storage': self.storage.metrics(),
+            'cache': self.cache.metrics(),
+        }
+
+    def _open(self, sha, offset, buf, fetch):
+        # reads the first chunk along with opening the object, so a small
+        # one is served in a single trip to the storage threads
+        f = self.store.open('cur', sha.hex())
+        size = f.seek(0, os.SEEK_END)
+        n = 0
+
+        if offset <= size and not (fetch and size > swarm.PIECE_SIZE):
+            f.seek(offset)
+            n = f.readinto(buf)
+
+        return f, size, n
+
+    async def open(self, sha, offset=0, buf=b'', fetch=False):
+        if sha not in self.objects:
+            return None
 
-    def open(self, sha):
         try:
-            return open(self._cur_path(sha.hex()), 'rb')
+            return await self.storage.run(self._open, sha, offset, buf, fetch)
         except FileNotFoundError:
             return None
 
     def list_objects(self):
-        return os.listdir(os.path.join(self.path, 'cur'))
+        return [sha.hex() for sha in self.objects]
+
+    async def object_sizes(self, shas):
+        return await self.storage.run(self.store.sizes, [sha.hex() for sha in shas])
+
+    async def manifest(self, sha, f):
+        manifest = self.manifests.get(sha)
+        if manifest is not None:
+            return manifest
+
+        manifest = await self.storage.run(swarm.compute_manifest, f)
+        self._cache_manifest(sha, manifest)
+        return manifest
+
+    def _cache_manifest(self, sha, manifest):
+        if len(self.manifests) >= MANIFEST_CACHE_SIZE:
+            del self.manifests[next(iter(self.manifests))]
 
-    def new_object(self, sha, conn):
-        if os.path.exists(self._cur_path(sha.hex())):
+        self.manifests[sha] = manifest
+
+    def iter_objects(self):
+        return iter(self.objects)
+
+    def _scan_objects(self):
+        for name in self.store.names('cur'):
+            yield bytes.fromhex(name)
+
+    def _scan_partials(self):
+        # sizes of what earlier attempts left in tmp/, so a request knows
+        # where to resume without waiting for the disk
+        with os.scandir(os.path.join(self.path, 'tmp')) as it:
+            return {
+                bytes.fromhex(entry.name): entry.stat().st_size
+                for entry in it if len(entry.name) == 64}
+
+    def _index_path(self):
+        return os.path.join(self.path, 'index')
+
+    def _load_index(self):
+        try:
+            with open(self._index_path(), 'rb') as f:
+                magic, mtime, n = INDEX_HEADER.unpack(f.read(INDEX_HEADER.size))
+                data = f.read()
+        except (OSError, ValueError):
+            return None
+
+        if magic != INDEX_MAGIC or len(data) != n * 32:
+            return None
+
+        if mtime != self.store.mtime('cur'):
+            return None
+
+        return reconcile.ObjectSet.from_bytes(data)
+
+    def _write_index(self, mtime, objects):
+        path = self._index_path()
+        data = objects.to_bytes()
+
+        with open(path + '.tmp', 'wb') as f:
+            f.write(INDEX_HEADER.pack(INDEX_MAGIC, mtime, len(data) // 32))
+            f.write(data)
+
+        os.replace(path + '.tmp', path)
+
+    def _snapshot_index(self, mtime):
+        # the mtime is taken before reading pending events, so every
+        # object in cur/ at that mtime is in the snapshot. objects in
+        # directories left to rescans are only known once a rescan
+        # started after they arrived
+        rescanned = self.store.rescanned
+        if rescanned is not None and mtime >= rescanned:
+            return None
+
+        self.monitor.on_inotify()
+        return self.objects.copy()
+
+    async def save_index(self):
+        if self.objects.version == self.saved:
             return
 
-        self.sha_to_conn[sha].add(conn)
-        self.conn_to_sha[conn].add(sha)
+        # an object created within the same clock tick would not change
+        # the mtime, so wait until cur/ has been quiet for a while
+        mtime = await self.storage.run(self.store.mtime, 'cur')
+        if time.time_ns() - mtime < 1000000000:
+            return
 
-        if sha in self.requesting:
+        objects = self._snapshot_index(mtime)
+        if objects is None:
             return
 
-        if conn.request_object(sha):
-            self.requesting.add(sha)
+        await self.storage.run(self._write_index, mtime, objects)
+        self.saved = objects.version
 
+    def close(self):
+        if self.objects.version != self.saved:
+            mtime = self.store.mtime('cur')
+            objects = self._snapshot_index(mtime)
+            if objects is not None:
+                self._write_index(mtime, objects)
+                self.saved = objects.version
 
-    def finish_object(self, sha, conn):
-        os.rename(self._tmp_path(sha.hex()), self._new_path(sha.hex()))
-        os.link(self._new_path(sha.hex()), self._cur_path(sha.hex()))
+    def new_object(self, sha, conn, size=None):
+        self.new_objects((sha,), conn, None if size is None else {sha: size})
 
-        s = self.sha_to_conn.pop(sha)
-        self.requesting.remove(sha)
+    def new_objects(self, shas, conn, sizes=None):
+        objs = self.conn_to_sha[conn]
 
-        for c in s:
-            objs = self.conn_to_sha[c]
-            objs.remove(sha)
+        for sha in shas:
+            conn.known.add(sha)
+
+            if sha in objs or sha in self.objects:
+                continue
+
+            self.sha_to_conn[sha].add(conn)
+            objs.add(sha)
 
-            candidates = objs - self.requesting
+            if sizes is not None:
+                self.sizes[sha] = sizes[sha]
 
-            if not candidates:
+            download = self.downloads.get(sha)
+            if download is not None:
+                download.fill(conn)
                 continue
 
-            choice = next(iter(candidates))
+            self.scheduler.announced(conn, sha)
+
+        self._fill(conn)
 
-            if c.request_object(choice):
-                self.requesting.add(choice)
+
+    def push_object(self, sha, data, conn):
+        conn.known.add(sha)
+
+        if sha in self.objects:
+            return
+
+        # the object is on its way already, but the pusher has it too
+        if sha in self.requesting:
+            self.new_object(sha, conn, len(data))
+            return
+
+        if hashlib.sha256(data).digest() != sha:
+            self.penalize(conn)
+            return
+
+        self.requesting.add(sha)
+        self.new_object(sha, conn, len(data))
+        ensure_future(self._store_pushed(sha, data, conn))
+
+    def _write_object(self, name, data, partial):
+        self.store.add(name, data)
+
+        if partial:
+            try:
+                os.unlink(self.store.tmp_path(name))
+            except FileNotFoundError:
+                pass
+
+        return self.store.size(name)
+
+    async def _add_object(self, sha, data):
+        # what an earlier attempt left in tmp/ goes, once its file is
+        # done with it
+        previous = self.files.pop(sha, None)
+        if previous is not None:
+            await previous.drain()
+
+        size = await self.storage.run(self._write_object, sha.hex(), data, sha in self.partials)
+        self.partials.pop(sha, None)
+        return size
+
+    async def _store_pushed(self, sha, data, conn):
+        try:
+            size = await self._add_object(sha, data)
+        except OSError:
+            self.fail_object(sha, conn)
+            return
+
+        self.cache.add(sha, data)
+        self.finish_object(sha, conn, size)
+
+    def verify_data(self, sha, conn, hasher, data):
+        ensure_future(self._verify_data(sha, conn, hasher, bytes(data)))
+        self._fill(conn)
+
+    async def _verify_data(self, sha, conn, hasher, data):
+        if await hasher.digest() != sha:
+            self.penalize(conn)
+            self.fail_object(sha, conn)
+            return
+
+        try:
+            size = await self._add_object(sha, data)
+        except OSError:
+            self.fail_object(sha, conn)
+            return
+
+        self.cache.add(sha, data)
+        self.finish_object(sha, conn, size)
+
+    def verify_object(self, sha, conn, hasher, file, offset=0):
+        ensure_future(self._verify_object(sha, conn, hasher, file, offset))
+        self._fill(conn)
+
+    async def _verify_object(self, sha, conn, hasher, file, offset):
+        ok = await hasher.digest() == sha
+        file.close_soon()
+
+        try:
+            if ok:
+                size = await file.run(self._commit, sha.hex())
+            else:
+                await file.run(os.unlink, file.path)
+        except OSError:
+            self.fail_object(sha, conn)
+            return
+
+        self.partials.pop(sha, None)
+        self._release_file(sha, file)
+
+        if ok:
+            self.finish_object(sha, conn, size)
+            return
+
+        # the part kept from an earlier attempt may be what was wrong, so
+        # only an object sent whole counts against the peer
+        if offset:
+            self.retry_object(sha, conn)
+            return
+
+        self.penalize(conn)
+        self.fail_object(sha, conn)
+
+
+    def _release_file(self, sha, file):
+        # done with the file, a later request need not wait for it
+        if self.files.get(sha) is file:
+            del self.files[sha]
+
+    def penalize(self, conn):
+        self.penalties[conn.addr] += 1
+
+        if self.penalties[conn.addr] >= MAX_PENALTIES and not conn.closed:
+            conn.transport.close()
+
+
+    def _commit(self, name):
+        self.store.commit(name)
+        return self.store.size(name)
+
+    def finish_object(self, sha, conn, size):
+        if self.objects.add(sha):
+            self.announce(sha, size)
+
+        s = self.sha_to_conn.pop(sha, set())
+        self.requesting.remove(sha)
+        self.sizes.pop(sha, None)
+        self.scheduler.finished(sha, size)
+
+        for c in s:
+            self.conn_to_sha[c].remove(sha)
+
+        for c in s:
+            self._fill(c)
 
 
     def fail_object(self, sha, conn):
-        self.conn_to_sha[conn].remove(sha)
+        # conn may have been lost while the object was checked
+        self.conn_to_sha.get(conn, set()).discard(sha)
         s = self.sha_to_conn[sha]
-        s.remove(conn)
+        s.discard(conn)
 
-        for c in s:
-            if conn.request_object(sha):
-                return
+        self.requesting.remove(sha)
+
+        for c in self.scheduler.sources(sha):
+            if c.request_object(sha):
+                self.requesting.add(sha)
+                break
+        else:
+            self.scheduler.released(sha)
+
+        self._fill(conn)
+
+
+    def start_download(self, sha, size, hashes, file, missing, conn):
+        download = swarm.Download(self, sha, size, hashes, file, missing, conn)
+        self.downloads[sha] = download
+        self.partials[sha] = size
+
+        if not download.remaining:
+            self.piece_finished(download, conn)
+            return
 
+        for c in list(self.sha_to_conn[sha]):
+            self._fill(c)
+
+
+    def piece_finished(self, download, conn):
+        sha = download.sha
+
+        if not download.remaining:
+            ensure_future(self._verify_download(download, conn))
+            return
+
+        sources = [c for c in self.sha_to_conn[sha] if c.features & FEATURE_SWARM]
+        if not download.inflight and all(c in download.bad for c in sources):
+            self.abort_download(download)
+            return
+
+        for c in sources:
+            self._fill(c)
+
+
+    async def _verify_download(self, download, conn):
+        sha = download.sha
+
+        # the pieces are only all on the disk once the file is closed
+        try:
+            await download.file.close()
+        except OSError:
+            self.abort_download(download)
+            return
+
+        hasher = Hasher()
+        hasher.update_file(download.file.path, download.size)
+
+        if await hasher.digest() != sha:
+            self.penalize(download.origin)
+            self.abort_download(download)
+            return
+
+        try:
+            size = await self.storage.run(self._commit, sha.hex())
+        except OSError:
+            self.abort_download(download)
+            return
+
+        del self.downloads[sha]
+        self.partials.pop(sha, None)
+        self._release_file(sha, download.file)
+        self._cache_manifest(sha, (download.size, download.hashes))
+        self.finish_object(sha, conn, size)
+
+
+    def abort_download(self, download):
+        # pieces keep failing against the manifest, so do not trust it
+        sha = download.sha
+        download.cancel()
+        download.file.close_soon()
+        download.file.unlink_soon()
+        self.partials.pop(sha, None)
+
+        del self.downloads[sha]
+        self.fail_object(sha, download.origin)
+
+
+    def retry_object(self, sha, conn):
         self.requesting.remove(sha)
+        self.scheduler.released(sha)
+        self._fill(conn)
+
+
+    def _fill(self, conn):
+        for sha in list(self.downloads):
+            if conn in self.sha_to_conn.get(sha, ()):
+                self.downloads[sha].fill(conn)
+
+        while conn.can_request():
+            sha = self.scheduler.next(conn)
+            if sha is None:
+                return
+
+            conn.request_object(sha)
+            self.requesting.add(sha)
 
 
     def connection_lost(self, conn):
@@ -275,6 +967,11 @@ class Club:
         for sha in s:
             self.sha_to_conn[sha].remove(conn)
 
+        for download in self.downloads.values():
+            download.bad.discard(conn)
+
+        self.scheduler.connection_lost(conn)
+
 
 class Connection(Protocol):
 
@@ -283,148 +980,542 @@ class Connection(Protocol):
         self.addr = addr
 
         self.club = endpoint.club
+        self.transport = None
 
         self.paused = False
-        self.pending_writes = deque()
+        self.resumed = None
 
-        self.buffer = b''
-        self.state = (2, self._decode_length)
+        # frames queued in this loop iteration, written out together
+        self.output = []
+        self.output_size = 0
+        self.flush_handle = None
+
+        self.decoder = FrameDecoder(self._decode_body)
+        self.features = 0
+        self.chunk_size = 1024
+        self.chunk_buffer = None
 
         self.responding = None
+        self.responding_id = None
+        self.cancelled = None
         self.to_respond = deque()
 
-        self.request = None
+        self.requests = {}
+        self.request_ids = count(1)
+        self.window = 1
+        self.closed = False
+        self.stats = scheduler.LinkStats(endpoint.loop)
+        self.known = known.KnownSet()
+
+        # objects to announce with their size and data, sent by one task
+        self.to_announce = []
+        self.announcing = None
 
 
     def pause_writing(self):
         self.paused = True
+        self.resumed = Future()
 
     def resume_writing(self):
         self.paused = False
+        self.resumed.set_result(None)
+
+    def _send(self, *parts):
+        n = sum(len(p) for p in parts)
+        frame = b''.join((encode_header(n),) + parts)
+
+        self.output.append(frame)
+        self.output_size += len(frame)
+
+        if self.output_size >= self.endpoint.flush_size:
+            self._flush()
+        elif self.flush_handle is None:
+            loop = self.endpoint.loop
+            delay = self.endpoint.flush_delay
+
+            if delay:
+                self.flush_handle = loop.call_later(delay, self._flush)
+            else:
+                self.flush_handle = loop.call_soon(self._flush)
+
+    def _flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+
+        if self.output and not self.closed:
+            self.transport.writelines(self.output)
+
+        self.output = []
+        self.output_size = 0
+
+    async def _write(self, *parts):
+        while self.paused:
+            await self.resumed
 
-        while self.pending_writes and not self.paused:
-            self.pending_writes.popleft().set_result(None)
+        self._send(*parts)
 
-    async def _write(self, data):
-        if not self.paused:
-            self.transport.write(pack("!H", len(data)) + data)
+
+    def write_object(self, sha, size=None, data=None):
+        self.known.add(sha)
+
+        if self._can_push(data):
+            return self._write(b'\x00\x13' + sha + data)
+
+        if not self.features & FEATURE_SIZES:
+            return self._write(b'\x00\x01' + sha)
+
+        return self._write(b'\x00\x01' + sha + pack("!Q", size))
+
+    def _can_push(self, data):
+        return (
+            data is not None and self.features & FEATURE_PUSH and
+            len(data) <= self.endpoint.push_size)
+
+    async def write_announcements(self, objects):
+        # pushed objects go one by one, the rest in inventory frames
+        rest = []
+        for sha, size, data in objects:
+            if self._can_push(data):
+                await self.write_object(sha, size, data)
+            else:
+                rest.append((sha, size))
+
+        if not self.features & FEATURE_INVENTORY:
+            for sha, size in rest:
+                await self.write_object(sha, size)
             return
 
-        future = Future()
-        self.pending_writes.append(future)
-        await future
+        if self.features & FEATURE_SIZES:
+            entries = [sha + pack("!Q", size) for sha, size in rest]
+            n = INVENTORY_SIZED_SIZE
+        else:
+            entries = [sha for sha, _ in rest]
+            n = INVENTORY_SIZE
+
+        for sha, _ in rest:
+            self.known.add(sha)
+
+        for i in range(0, len(entries), n):
+            await self.write_inventory(entries[i:i+n])
+
+    def write_peers(self, peers):
+        return self._write(b'\x00\x02' + b''.join(peers))
 
+    def write_inventory(self, shas):
+        return self._write(b'\x00\x08', *shas)
 
-    def write_object(self, sha):
-        return self._write(b'\x00\x01' + sha)
+    def write_summary(self, entries):
+        return self._write(b'\x00\x09' + reconcile.encode_summary(entries))
 
-    def write_peer(self, peer):
-        return self._write(b'\x00\x02' + peer)
+    def write_items(self, bits, prefix, shas):
+        return self._write(b'\x00\x0a' + reconcile.RANGE.pack(bits, prefix), *shas)
 
+    def write_manifest(self, id, size, hashes):
+        return self._write(b'\x00\x11' + id + swarm.encode_manifest(size, hashes))
 
-    async def write_response(self, sha):
-        f = self.club.open(sha)
+    def write_hello(self):
+        return self._write(b'\x00\x07' + pack("!I", FEATURES))
 
-        if f is None:
-            await self._write(b'\x00\x06' + b'\x01\x94')
+
+    async def write_response(self, sha, id, offset=0, length=None, fetch=False):
+        if id is None:
+            data, last, error = b'\x00\x04', b'\x00\x05', b'\x00\x06'
+        else:
+            rid = pack("!I", id)
+            data, last, error = b'\x00\x0c' + rid, b'\x00\x0d' + rid, b'\x00\x0e' + rid
+
+        cached = self.club.cache.get(sha)
+        if cached is not None and not (fetch and len(cached) > swarm.PIECE_SIZE):
+            await self._write_cached(cached, id, offset, length, data, last, error)
             return
 
-        with f:
-            last = f.read(1024)
+        if self.chunk_buffer is None:
+            self.chunk_buffer = bytearray(self.chunk_size)
 
-            while True:
-                cur = f.read(1024)
-                if len(cur) == 0:
-                    await self._write(b'\x00\x05' + last)
+        with memoryview(self.chunk_buffer) as buf:
+            opened = await self.club.open(sha, offset, buf[:length], fetch)
+
+            if opened is None:
+                await self._write(error + pack("!H", ERROR_NOT_FOUND))
+                return
+
+            f, size, n = opened
+
+            with f:
+                if fetch and size > swarm.PIECE_SIZE:
+                    f.seek(0)
+                    await self.write_manifest(rid, *await self.club.manifest(sha, f))
                     return
 
-                await self._write(b'\x00\x04' + last)
-                last = cur
+                if offset > size:
+                    await self._write(error + pack("!H", ERROR_BAD_RANGE))
+                    return
+
+                if offset == 0 and n == size:
+                    self.club.cache.add(sha, bytes(buf[:n]))
+
+                remaining = size - offset
+                if length is not None:
+                    remaining = min(remaining, length)
+
+                while True:
+                    remaining -= n
+
+                    if n == 0 or remaining <= 0:
+                        await self._write(last, buf[:n])
+                        return
+
+                    await self._write(data, buf[:n])
+
+                    if id is not None and self.cancelled == id:
+                        return
+
+                    n = await self.club.storage.run(f.readinto, buf[:remaining])
+
+    async def _write_cached(self, view, id, offset, length, data, last, error):
+        size = len(view)
+        if offset > size:
+            await self._write(error + pack("!H", ERROR_BAD_RANGE))
+            return
+
+        end = size if length is None else min(size, offset + length)
+
+        while True:
+            n = min(end - offset, self.chunk_size)
+
+            if offset + n >= end:
+                await self._write(last, view[offset:end])
+                return
+
+            await self._write(data, view[offset:offset+n])
+            offset += n
+
+            if id is not None and self.cancelled == id:
+                return
+
+    async def _do_respond(self, sha, id, *args):
+        self.responding_id = id
+        self.cancelled = None
 
-    async def _do_respond(self, sha):
-        await self.write_response(sha)
+        await self.write_response(sha, id, *args)
 
         if not self.to_respond:
             self.responding = None
         else:
-            self.responding = ensure_future(self._do_respond(self.to_respond.popleft()))
+            self.responding = ensure_future(self._do_respond(*self.to_respond.popleft()))
 
 
-    def handle_request(self, sha):
+    def handle_request(self, sha, id=None, *args):
         if self.responding is not None:
-            self.to_respond.append(sha)
+            self.to_respond.append((sha, id) + args)
             return
 
-        self.responding = ensure_future(self._do_respond(sha))
+        self.responding = ensure_future(self._do_respond(sha, id, *args))
+
+    def handle_cancel(self, id):
+        if self.responding is not None and self.responding_id == id:
+            self.cancelled = id
+        else:
+            self.to_respond = deque(r for r in self.to_respond if r[1] != id)
+
+
+    def _send_request(self, sha, id, offset):
+        if id is None:
+            self._send(b'\x00\x03' + sha)
+            return
 
+        t = b'\x00\x0f' if self.features & FEATURE_SWARM else b'\x00\x0b'
+        if offset:
+            self._send(t + pack("!I", id) + sha + pack("!Q", offset))
+        else:
+            self._send(t + pack("!I", id) + sha)
 
-    async def _do_request(self, sha):
-        await self._write(b'\x00\x03' + sha)
+    def can_request(self):
+        if self.closed:
+            return False
+        return len(self.requests) < self.club.scheduler.window(self)
+
+    def can_request_piece(self):
+        return self.features & FEATURE_SWARM and self.can_request()
+
+    def announce(self, objects):
+        self.to_announce.extend(objects)
+
+        if self.announcing is None:
+            self.announcing = ensure_future(self._send_announcements())
+
+    async def _send_announcements(self):
+        # waits while the peer is slow to read, collecting what comes
+        # meanwhile into the next batch
+        while self.to_announce and not self.closed:
+            objects = self.to_announce
+            self.to_announce = []
+            await self.write_announcements(objects)
+
+        self.announcing = None
+
+    def send_peers(self, peers):
+        if self.features & FEATURE_PEX:
+            ensure_future(self.write_peers(peers))
+
+    def handle_peers(self, data):
+        if len(data) % 6:
+            raise ValueError("bad peer list")
+
+        data = bytes(data)
+        self.endpoint.peers.received(self, [data[i:i+6] for i in range(0, len(data), 6)])
 
     def request_object(self, sha):
-        if self.request is not None:
+        if not self.can_request():
             return False
 
-        self.request = ObjectRequest(self.club, self, sha)
-        ensure_future(self._do_request(sha))
+        if self.features & FEATURE_REQUEST_ID:
+            id = next(self.request_ids)
+        else:
+            id = None
+
+        request = ObjectRequest(
+            self.club, self, sha, id, self.features & FEATURE_RESUME)
+        self.requests[id] = request
+        self.stats.request_sent(id)
+        self._send_request(sha, id, request.offset)
         return True
 
+    def request_piece(self, download, index):
+        id = next(self.request_ids)
+        request = swarm.PieceRequest(download, self, index, id)
+        self.requests[id] = request
+        self.stats.request_sent(id)
+
+        self._send(
+            b'\x00\x10' + pack("!I", id) + download.sha +
+            pack("!QI", request.offset, request.length))
+        return request
+
+    def cancel_request(self, id):
+        self.stats.forget(id)
+        self._send(b'\x00\x12' + pack("!I", id))
+
     async def _send_object_list(self):
-        objects = self.club.list_objects()
-        for o in objects:
-            await self.write_object(bytes.fromhex(o))
+        await self._send_inventory(self.club.iter_objects())
+
+    async def _send_inventory(self, objects):
+        sized = self.features & FEATURE_SIZES
+        n = INVENTORY_SIZED_SIZE if sized else INVENTORY_SIZE
+
+        while True:
+            shas = list(islice(objects, n))
+            if not shas:
+                return
+
+            # a frame of objects is sized in one trip to the storage threads
+            if sized:
+                sizes = await self.club.object_sizes(shas)
+            else:
+                sizes = [None] * len(shas)
+
+            if not self.features & FEATURE_INVENTORY:
+                for sha, size in zip(shas, sizes):
+                    await self.write_object(sha, size)
+                continue
+
+            for sha in shas:
+                self.known.add(sha)
+
+            if sized:
+                entries = [sha + pack("!Q", size) for sha, size in zip(shas, sizes)]
+            else:
+                entries = shas
+
+            await self.write_inventory(entries)
 
     def connection_made(self, transport):
         self.transport = transport
-        ensure_future(self._send_object_list())
+
+        sslobj = transport.get_extra_info('ssl_object')
+        if sslobj.selected_alpn_protocol() != ALPN_PROTOCOL:
+            self._start()
+            return
+
+        ensure_future(self.write_hello())
+
+    def _start(self):
+        if self.features & FEATURE_LARGE_FRAMES:
+            self.chunk_size = self.endpoint.chunk_size
+
+        if self.features & FEATURE_REQUEST_ID:
+            self.window = self.endpoint.window
+
+        # pieces are requested by id, and manifests need large frames
+        if ~self.features & (FEATURE_REQUEST_ID | FEATURE_LARGE_FRAMES):
+            self.features &= ~FEATURE_SWARM
+
+        if not self.features & FEATURE_REQUEST_ID:
+            self.features &= ~FEATURE_RESUME
+
+        self.endpoint.peers.connected(self)
+
+        if not self.features & FEATURE_RECONCILE:
+            ensure_future(self._send_object_list())
+        elif not self.transport.get_extra_info('ssl_object').server_side:
+            root = (0, 0) + self.club.objects.summary(0, 0)
+            ensure_future(self.write_summary([root]))
+
+    def handle_hello(self, data):
+        features, = unpack("!I", data[:4])
+        self.features = features & FEATURES
+        self._start()
 
 
     def connection_lost(self, exc):
-        if self.request is not None:
-            self.request.fail()
+        self.closed = True
+        self._flush()
+
+        for request in list(self.requests.values()):
+            request.fail()
 
         if self.responding is not None:
             self.responding.cancel()
 
         self.club.connection_lost(self)
-        self.endpoint.connections.pop(self.addr)
+        self.endpoint.remove(self)
+        self.endpoint.peers.lost(self)
 
 
-    def data_received(self, data):
-        self.buffer += data
+    def handle_inventory(self, data):
+        n = 40 if self.features & FEATURE_SIZES else 32
+        if len(data) % n:
+            raise ValueError("bad inventory")
+
+        data = bytes(data)
+        shas = [data[i:i+32] for i in range(0, len(data), n)]
+
+        if n == 32:
+            self.club.new_objects(shas, self)
+            return
+
+        sizes = {
+            sha: unpack_from("!Q", data, i + 32)[0]
+            for sha, i in zip(shas, range(0, len(data), n))}
+        self.club.new_objects(shas, self, sizes)
 
-        while len(self.buffer) >= self.state[0]:
-            n = self.state[0]
-            packet = self.buffer[:n]
-            self.buffer = self.buffer[n:]
-            self.state = self.state[1](packet)
+    def handle_summary(self, data):
+        entries = reconcile.decode_summary(bytes(data))
+        summaries, ranges = reconcile.compare(self.club.objects, entries)
+        ensure_future(self._send_reconcile(summaries, ranges))
 
-    def _decode_length(self, data):
-        n, = unpack('!H', data)
-        return (n, self._decode_body)
+    async def _send_reconcile(self, summaries, ranges):
+        n = reconcile.SUMMARY_SIZE
+        for i in range(0, len(summaries), n):
+            await self.write_summary(summaries[i:i+n])
 
+        for bits, prefix in ranges:
+            await self.write_items(
+                bits, prefix, self.club.objects.items_in(bits, prefix))
+
+    def handle_items(self, data):
+        bits, prefix, theirs = reconcile.decode_items(bytes(data))
+        objects = self.club.objects
+
+        self.club.new_objects([sha for sha in theirs if sha not in objects], self)
+
+        # the range may hold the whole store, so it is walked as it is sent
+        missing = (sha for sha in objects.iter_in(bits, prefix) if sha not in theirs)
+        ensure_future(self._send_inventory(missing))
+
+    def handle_response(self, t, data):
+        id, = unpack("!I", data[:4])
+
+        # cancelled requests may still be answered
+        request = self.requests.get(id)
+        if request is None:
+            return
 
-    def _decode_body(self, data):
-        t, = unpack("!H", data[:2])
+        self.stats.response(id, len(data) - 4)
 
+        if t == 12:
+            request.write(data[4:])
+        elif t == 13:
+            request.write(data[4:])
+            request.finish()
+        elif t == 17:
+            request.manifest(bytes(data[4:]))
+        else:
+            request.fail(decode_error(data[4:]))
+
+        if not self.requests:
+            self.stats.idle()
+
+    def data_received(self, data):
+        self.decoder.feed(data)
+
+
+    def _decode_body(self, t, data):
+        # data is a view into the receive buffer, copy anything kept
         if t == 1:
-            sha = data[2:]
-            self.club.new_object(sha, self)
-        elif t == 2: # peer
-            raise NotImplementedError
+            if len(data) == 40 and self.features & FEATURE_SIZES:
+                self.club.new_object(bytes(data[:32]), self, unpack("!Q", data[32:])[0])
+            else:
+                self.club.new_object(bytes(data), self)
+        elif t == 2:
+            self.handle_peers(data)
         elif t == 3:
-            self.handle_request(data[2:])
+            self.handle_request(bytes(data))
         elif t == 4:
-            self.request.write(data)
+            self.stats.response(None, len(data))
+            self.requests[None].write(data)
         elif t == 5:
-            self.request.write(data)
-            self.request.finish()
+            self.stats.response(None, len(data))
+            self.requests[None].write(data)
+            self.requests[None].finish()
         elif t == 6:
-            self.request.fail()
+            self.stats.response(None, 0)
+            self.requests[None].fail(decode_error(data))
+        elif t == 7:
+            self.handle_hello(data)
+        elif t == 8:
+            self.handle_inventory(data)
+        elif t == 9:
+            self.handle_summary(data)
+        elif t == 10:
+            self.handle_items(data)
+        elif t == 11:
+            id, sha, offset = decode_request(data)
+            self.handle_request(sha, id, offset)
+        elif t in (12, 13, 14, 17):
+            self.handle_response(t, data)
+        elif t == 15:
+            id, sha, offset = decode_request(data)
+            self.handle_request(sha, id, offset, None, True)
+        elif t == 16:
+            id, = unpack("!I", data[:4])
+            offset, length = unpack("!QI", data[36:48])
+            self.handle_request(bytes(data[4:36]), id, offset, length)
+        elif t == 18:
+            id, = unpack("!I", data[:4])
+            self.handle_cancel(id)
+        elif t == 19:
+            if len(data) < 32:
+                raise ValueError("bad push")
+            self.club.push_object(bytes(data[:32]), bytes(data[32:]), self)
         else:
             raise NotImplementedError
 
-        return (2, self._decode_length)
+
+def decode_request(data):
+    id, = unpack("!I", data[:4])
+    if len(data) > 36:
+        offset, = unpack("!Q", data[36:44])
+    else:
+        offset = 0
+
+    return id, bytes(data[4:36]), offset
+
+def decode_error(data):
+    if len(data) < 2:
+        return None
+    return unpack("!H", data[:2])[0]
 
 
 def encode_addr(addr):
@@ -436,15 +1527,40 @@ def decode_addr(b):
 
 class TcpEndpoint:
 
-    def __init__(self, club, addr, loop=None):
+    def __init__(self, club, addr, loop=None, chunk_size=256*1024, window=16,
+                 flush_size=64*1024, flush_delay=0, push_size=PUSH_SIZE,
+                 degree=peers.TARGET_DEGREE, max_degree=peers.MAX_DEGREE,
+                 max_handshakes=MAX_HANDSHAKES, max_connections=MAX_CONNECTIONS):
         self.club = club
         self.addr = addr
         self.connections = {}
+        self.chunk_size = chunk_size
+        self.window = window
+        self.flush_size = flush_size
+        self.flush_delay = flush_delay
+        self.push_size = push_size
 
         if loop is None:
             loop = get_event_loop()
         self.loop = loop
 
+        self.peers = peers.PeerManager(self, degree, max_degree)
+
+        # accepted sockets waiting for a handshake slot, with the time
+        # they were accepted
+        self.max_handshakes = max_handshakes
+        self.max_connections = max_connections
+        self.handshakes = 0
+        self.admission = deque()
+
+        self.accepted = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.max_queued = 0
+        self.handshaked = 0
+        self.handshake_time = 0.0
+        self.queue_time = 0.0
+
         club.endpoints.add(self)
         ensure_future(self._do_accept())
 
@@ -463,19 +1579,112 @@ class TcpEndpoint:
 
         while True:
             conn, addr = await self.loop.sock_accept(s)
-            addr = encode_addr(addr)
+            self.accepted += 1
+
+            if len(self.connections) >= self.max_connections:
+                self._reject(conn)
+            elif self.handshakes < self.max_handshakes:
+                self._start_handshake(conn, addr, self.loop.time())
+            elif len(self.admission) < ADMISSION_QUEUE:
+                self.admission.append((conn, addr, self.loop.time()))
+                self.max_queued = max(self.max_queued, len(self.admission))
+            else:
+                self._reject(conn)
+
+    def _reject(self, conn):
+        self.rejected += 1
+        conn.close()
+
+    def _admit(self):
+        while self.admission and self.handshakes < self.max_handshakes:
+            conn, addr, accepted = self.admission.popleft()
+
+            if (self.loop.time() - accepted > ADMISSION_TIMEOUT or
+                    len(self.connections) >= self.max_connections):
+                self._reject(conn)
+                continue
+
+            self._start_handshake(conn, addr, accepted)
+
+    def _start_handshake(self, conn, addr, accepted):
+        self.handshakes += 1
+        self.queue_time += self.loop.time() - accepted
+        ensure_future(self._admitted(conn, addr))
+
+    async def _admitted(self, conn, addr):
+        try:
+            await self._accept(conn, encode_addr(addr))
+        finally:
+            self.handshakes -= 1
+            self._admit()
+
+    async def _accept(self, conn, addr):
+        # the peer connected again, so the link it had is dead or
+        # about to be, and only one link is kept per peer
+        old = self.connections.get(addr)
+        if old is not None and old.transport is not None:
+            old.transport.close()
+
+        connection = Connection(self, addr)
+        ssl_protocol = PeerSSLProtocol(self.loop, connection)
+        self.connections[addr] = connection
+
+        start = self.loop.time()
+        if await self._handshake(connection, ssl_protocol, conn):
+            self.handshaked += 1
+            self.handshake_time += self.loop.time() - start
+
+    async def _handshake(self, connection, ssl_protocol, sock):
+        # returns whether the handshake finished. a link which fails or
+        # stalls in it is dropped, a stalled one would hold its slot and
+        # its place in connections for good
+        proto = ssl_protocol.proxy
 
-            connection = Connection(self, addr)
-            proto = PeerSSLProtocol(self.loop, connection).proxy
+        try:
+            transport, _ = await self.loop.create_connection(lambda: proto, sock=sock)
+        except OSError:
+            ssl_protocol.task.cancel()
+            self.remove(connection)
+            return False
 
-            self.connections[addr] = proto
-            transport, _ = await self.loop.create_connection(lambda: proto, sock=conn)
+        task = ssl_protocol.task
+        await wait((task,), timeout=HANDSHAKE_TIMEOUT)
+
+        if not task.done():
+            self.timeouts += 1
+            task.cancel()
+            transport.close()
+            self.remove(connection)
+            return False
 
+        return not task.cancelled() and task.exception() is None
+
+    def metrics(self):
+        started = self.accepted - self.rejected - len(self.admission)
+        return {
+            'connections': len(self.connections),
+            'handshakes': self.handshakes,
+            'queued': len(self.admission),
+            'max_queued': self.max_queued,
+            'accepted': self.accepted,
+            'rejected': self.rejected,
+            'timeouts': self.timeouts,
+            'handshake_latency':
+                self.handshake_time / self.handshaked if self.handshaked else 0.0,
+            'queue_latency': self.queue_time / started if started else 0.0,
+        }
+
+
+    def remove(self, connection):
+        # a newer link to the same peer may have taken its place
+        if self.connections.get(connection.addr) is connection:
+            del self.connections[connection.addr]
 
     def connect(self, peer):
-        if peer in self.connections:
+        if peer in self.connections or peer in self.peers.connecting:
             return
 
+        self.peers.connecting_to(peer)
         return ensure_future(self._do_connect(peer))
 
 
@@ -489,14 +1698,19 @@ class TcpEndpoint:
         s.bind(self.addr)
 
         try:
-            await self.loop.sock_connect(s, addr)
-        except OSError:
+            await wait_for(self.loop.sock_connect(s, addr), HANDSHAKE_TIMEOUT)
+        except (OSError, TimeoutError):
+            s.close()
+            self.peers.failed(peer)
             return
 
-        connection = Connection(self, addr)
-        proto = PeerSSLProtocol(self.loop, connection).proxy
-        self.connections[addr] = proto
-        transport, _ = await self.loop.create_connection(lambda: proto, sock=s)
+        connection = Connection(self, peer)
+        ssl_protocol = PeerSSLProtocol(self.loop, connection)
+        self.connections[peer] = connection
+
+        # a handshake which failed on its own has reported it already
+        if not await self._handshake(connection, ssl_protocol, s) and peer in self.peers.connecting:
+            self.peers.failed(peer)
 
 
 def create_periodic_task(f, delay, interval):
@@ -511,40 +1725,173 @@ def create_periodic_task(f, delay, interval):
 
 class TcpTrackerClient:
 
-    def __init__(self, club, host, port, interval=5, delay=2):
-        self.club = club
+    # a session with the tracker is kept open, and the tracker sends the
+    # peers which join or leave. while no session can be had the tracker
+    # is polled, less often after failures or when nothing changes. one
+    # announce covers every club of the process. a tracker which does not
+    # answer in time is given up on, so one which stalls cannot hold up
+    # the client, but the tracker must know about clubs, older ones do not
+    # understand either announce
+
+    def __init__(self, clubs, host, port, interval=5, delay=2):
+        self.clubs = clubs
         self.host = host
         self.port = port
-        create_periodic_task(self.announce, delay, interval)
+        self.interval = interval
+        self.local = {}
+        ensure_future(self._run(delay))
+
+    def _encode(self, magic):
+        self.local = {
+            club.id: [e.get_address() for e in club.endpoints]
+            for club in self.clubs}
+
+        return tracker.encode_announce(list(self.local.items()), magic)
+
+    def _add_peers(self, club_id, peers):
+        # returns how many were not known yet
+        local_addrs = self.local.get(club_id, ())
+        new = 0
+
+        for club in self.clubs:
+            if club.id != club_id:
+                continue
+
+            for peer in peers:
+                if peer in local_addrs:
+                    continue
+
+                for endpoint in club.endpoints:
+                    new += peer not in endpoint.peers.peers
+                    endpoint.peers.add(peer)
+
+        return new
+
+    def _forget_peers(self, club_id, peers):
+        for club in self.clubs:
+            if club.id == club_id:
+                for peer in peers:
+                    for endpoint in club.endpoints:
+                        endpoint.peers.forget(peer)
+
+    async def _run(self, delay):
+        await sleep(delay)
+        wait = self.interval
+
+        while True:
+            if await self.session():
+                wait = self.interval
+            else:
+                new = await self.announce()
+
+                if new:
+                    wait = self.interval
+                else:
+                    wait = min(MAX_POLL_INTERVAL, wait * 2)
+
+            await sleep(uniform(wait / 2, wait))
+
+    async def session(self):
+        # returns whether the session was up before it ended
+        try:
+            reader, writer = await wait_for(
+                open_connection(self.host, self.port), TRACKER_TIMEOUT)
+        except (OSError, TimeoutError):
+            return False
+
+        established = False
+        keepalive = ensure_future(self._keepalive(writer))
+
+        try:
+            while True:
+                # the tracker answers every keepalive
+                timeout = KEEPALIVE + TRACKER_TIMEOUT if established else TRACKER_TIMEOUT
+                club_id, kind, peers = await wait_for(tracker.read_delta(reader), timeout)
+                established = True
+
+                if kind == tracker.JOIN:
+                    self._add_peers(club_id, peers)
+                elif kind == tracker.LEAVE:
+                    self._forget_peers(club_id, peers)
+        except (OSError, IncompleteReadError, TimeoutError):
+            pass
+        finally:
+            keepalive.cancel()
+            writer.close()
+
+        return established
+
+    async def _keepalive(self, writer):
+        while True:
+            writer.write(self._encode(tracker.SESSION))
+            await sleep(KEEPALIVE)
 
     async def announce(self):
+        # returns how many peers were new, None if the tracker could not
+        # be reached
         try:
-            reader, writer = await open_connection(self.host, self.port)
-        except OSError:
-            return
+            reader, writer = await wait_for(
+                open_connection(self.host, self.port), TRACKER_TIMEOUT)
+        except (OSError, TimeoutError):
+            return None
 
-        local_addrs = [e.get_address() for e in self.club.endpoints]
+        writer.write(self._encode(tracker.MULTI))
 
-        n = len(self.club.endpoints)
-        writer.write(pack("!H", n) + b''.join(local_addrs))
+        try:
+            data = await wait_for(reader.read(), TRACKER_TIMEOUT)
+        except (OSError, TimeoutError):
+            return None
+        finally:
+            writer.close()
 
-        n = await reader.read(2)
-        if len(n) != 2:
-            return
+        try:
+            response = tracker.decode_response(data)
+        except (ValueError, struct_error):
+            return None
 
-        n, = unpack("!H", n)
+        return sum(
+            self._add_peers(club_id, peers)
+            for club_id, peers in response.items())
 
-        for _ in range(n):
-            peer = await reader.read(6)
 
-            if len(peer) != 6:
-                return
+class DhtClient:
+
+    # finds peers through the dht instead of, or as well as, the tracker.
+    # the endpoints of each club are stored on the nodes closest to its
+    # id, which answer with the peers stored before. until some peers are
+    # found this is done more often, as the dht may have been empty
+
+    def __init__(self, clubs, node, bootstrap=(), interval=5, delay=2):
+        self.clubs = clubs
+        self.node = node
+        self.bootstrap = bootstrap
+        self.interval = interval
+        ensure_future(self._run(delay))
 
-            for endpoint in self.club.endpoints:
-                if peer not in local_addrs:
-                    endpoint.connect(peer)
+    async def _run(self, delay):
+        await sleep(delay)
+        wait = self.interval
+
+        while True:
+            if not len(self.node.table):
+                await self.node.bootstrap(self.bootstrap)
+
+            found = 0
+            for club in self.clubs:
+                local = [e.get_address() for e in club.endpoints]
+
+                for peer in await self.node.announce(club.id, local):
+                    if peer not in local:
+                        found += 1
+                        for endpoint in club.endpoints:
+                            endpoint.peers.add(peer)
+
+            if found:
+                wait = dht.ANNOUNCE_INTERVAL
+            else:
+                wait = min(dht.ANNOUNCE_INTERVAL, wait * 2)
 
-        writer.close()
+            await sleep(uniform(wait / 2, wait))
 
 
 def run_loop(loop):
@@ -554,17 +1901,35 @@ def run_loop(loop):
         loop.close()
 
 
-def main(port, path):
+def main(port, path, name=None, bootstrap=None):
     loop = get_event_loop()
     monitor = inotify.Monitor(loop)
 
-    club = Club(path, monitor)
+    # peers of the same club find each other through the tracker
+    if name is None:
+        club_id = tracker.DEFAULT_CLUB
+    else:
+        club_id = hashlib.sha256(name.encode()).digest()
+
+    club = Club(path, monitor, club_id=club_id)
 
     endpoint = TcpEndpoint(club, ("127.0.0.1", port), loop)
-    client = TcpTrackerClient(club, "127.0.0.1", 10000)
-    run_loop(loop)
+    client = TcpTrackerClient([club], "127.0.0.1", 10000)
+
+    # given the address of any dht node, peers are also found through the
+    # dht, with a node on the udp port of the same number
+    if bootstrap is not None:
+        host, _, node_port = bootstrap.rpartition(":")
+        node = dht.Node(("127.0.0.1", port), loop=loop)
+        loop.run_until_complete(node.start())
+        DhtClient([club], node, [(host, int(node_port))])
+
+    try:
+        run_loop(loop)
+    finally:
+        club.close()
 
 
 if __name__ == '__main__':
     import sys
-    main(int(sys.argv[1]), sys.argv[2])
+    main(int(sys.argv[1]), *sys.argv[2:])
@@ -6,27 +6,31 @@ from email import message_from_binary_file
 from asyncio import get_event_loop
 
 import inotify
+import packfile
 
 
-def deliver(server, path, name):
-    cur_path = os.path.join(path, 'cur', name)
-    new_path = os.path.join(path, 'new', name)
+def send(server, s, name):
+    with s.open('cur', name) as f:
+        msg = message_from_binary_file(f)
+
+    msg['Message-ID'] = '<%s>'%(name)
+
+    server.sendmail("user", ["user"], msg.as_bytes())
+
 
-    if not os.path.exists(new_path):
+def deliver(server, s, name):
+    if not s.exists('new', name):
         return
 
-    if not os.path.exists(cur_path):
+    new_path = s.object_path('new', name)
+
+    if not s.exists('cur', name):
         try:
-            os.link(new_path, cur_path)
+            s.link(new_path, 'cur', name)
         except FileExistsError:
             pass
 
-    with open(new_path, 'rb') as f:
-        msg = message_from_binary_file(f)
-
-    msg['Message-ID'] = '<%s>'%(name)
-
-    server.sendmail("user", ["user"], msg.as_bytes())
+    send(server, s, name)
     os.unlink(new_path)
 
 
@@ -44,13 +48,50 @@ def main(path):
     server = smtplib.LMTP(os.path.join(path, "dovecot", "lmtp"))
     server.set_debuglevel(1)
 
+    stores = [packfile.open_store(path)]
+    journal = packfile.Journal(path)
+    packs = os.path.join(path, 'packs')
+
     def callback(e):
-        deliver(server, path, e.name)
+        deliver(server, stores[0], e.name)
+
+    def deliver_packed():
+        names = journal.read()
+
+        # the store may have been given packs after this started
+        if names and not isinstance(stores[0], packfile.PackStore):
+            stores[0] = packfile.PackStore(path)
+
+        for name in names:
+            send(server, stores[0], name)
+            journal.advance()
+
+    def on_journal(e):
+        if e.name == packfile.JOURNAL:
+            deliver_packed()
+
+    watching = []
+
+    def watch_packs():
+        if not watching:
+            watching.append(m.register(packs, inotify.IN_MODIFY | inotify.IN_CREATE, on_journal))
+            deliver_packed()
+
+    def on_root(e):
+        if e.name == 'packs' and e.mask & inotify.IN_ISDIR:
+            watch_packs()
+
+    stores[0].watch(m, 'new', inotify.IN_MOVED_TO, callback)
+
+    if not os.path.isdir(packs):
+        m.register(path, inotify.IN_CREATE, on_root)
 
-    m.register(os.path.join(path, 'new'), inotify.IN_MOVED_TO, callback)
+    # also when packs/ was created before the watch was in place
+    if os.path.isdir(packs):
+        watch_packs()
 
-    for name in os.listdir(os.path.join(path, 'new')):
-        deliver(server, path, name)
+    for name in list(stores[0].names('new')):
+        deliver(server, stores[0], name)
 
     run_loop(loop)
     server.quit()
@@ -0,0 +1,400 @@
+#!/usr/bin/env python3
+
+# peers can find each other without the tracker through a kademlia style
+# distributed hash table over udp. nodes have random 32 byte ids, the
+# size of club ids, and the distance between ids is their xor. a node
+# keeps up to K nodes for each length of prefix they share with its own
+# id, preferring nodes which have been around longer, and finds the
+# nodes closest to an id by asking ALPHA of the closest it knows at a
+# time. the peers of a club are stored on the K nodes closest to its id.
+#
+# a node only takes an announce carrying the token it gave the sender
+# with its answer to a GET, which shows the sender gets datagrams at the
+# address it sends from. announced peers are stored with that address,
+# so a datagram can only point lookups at the host which sent it. tokens
+# hash the address with a secret that changes every TOKEN_INTERVAL, and
+# the one before is still taken
+
+from asyncio import (
+    get_event_loop, ensure_future, gather, sleep, wait_for,
+    DatagramProtocol, Future, TimeoutError)
+from collections import OrderedDict
+from itertools import count
+from os import urandom
+import hashlib
+from random import randrange, sample
+from socket import inet_aton, inet_ntoa
+from struct import Struct, pack, unpack_from, error as struct_error
+
+
+K = 8
+ALPHA = 3
+
+# seconds to wait for an answer
+RPC_TIMEOUT = 1
+
+# peers are kept this long after their last announce, which they repeat
+# every ANNOUNCE_INTERVAL
+PEER_TTL = 30 * 60
+ANNOUNCE_INTERVAL = 5 * 60
+
+# a lookup for a random id keeps the routing table fresh
+REFRESH_INTERVAL = 15 * 60
+
+# most peers given in an answer, so it fits in one datagram
+RESPONSE_SIZE = 64
+
+# most addresses one announce may store, and most peers and clubs a node
+# stores. a full club drops its oldest peer for a new one, announces for
+# new clubs are ignored while there are too many
+MAX_ADDRS = 16
+MAX_PEERS = 1024
+MAX_SWARMS = 4096
+
+# how often expired peers are dropped
+SWEEP_INTERVAL = 60
+
+TOKEN_INTERVAL = 5 * 60
+TOKEN_SIZE = 8
+
+PING = 1
+PONG = 2
+FIND_NODE = 3
+NODES = 4
+GET = 5
+PEERS = 6
+ANNOUNCE = 7
+ACK = 8
+
+# kind, transaction id, id of the sender
+HEADER = Struct("!BI32s")
+NODE = Struct("!32s6s")
+
+
+def encode_addr(addr):
+    return inet_aton(addr[0]) + pack("!H", addr[1])
+
+def decode_addr(b):
+    return (inet_ntoa(b[:4]), unpack_from("!H", b, 4)[0])
+
+
+def distance(a, b):
+    return int.from_bytes(a, 'big') ^ int.from_bytes(b, 'big')
+
+
+def encode_nodes(nodes):
+    return pack("!B", len(nodes)) + b''.join(
+        NODE.pack(node_id, encode_addr(addr)) for node_id, addr in nodes)
+
+def decode_nodes(data, offset=0):
+    n, = unpack_from("!B", data, offset)
+    offset += 1
+
+    nodes = []
+    for _ in range(n):
+        node_id, addr = NODE.unpack_from(data, offset)
+        nodes.append((node_id, decode_addr(addr)))
+        offset += NODE.size
+
+    return nodes
+
+
+def encode_peers(peers):
+    return pack("!H", len(peers)) + b''.join(peers)
+
+def decode_peers(data, offset=0):
+    n, = unpack_from("!H", data, offset)
+    offset += 2
+    end = offset + 6 * n
+
+    if len(data) < end:
+        raise ValueError("short peer list")
+
+    return [bytes(data[i:i+6]) for i in range(offset, end, 6)], end
+
+
+class RoutingTable:
+
+    def __init__(self, own):
+        self.own = own
+
+        # a bucket for each length of shared prefix, least recently seen
+        # first, and nodes to take the place of those which fail
+        self.buckets = [OrderedDict() for _ in range(len(own) * 8)]
+        self.replacements = [OrderedDict() for _ in range(len(own) * 8)]
+
+    def __len__(self):
+        return sum(len(b) for b in self.buckets)
+
+    def _index(self, node_id):
+        return len(self.buckets) - distance(self.own, node_id).bit_length()
+
+    def seen(self, node_id, addr):
+        if node_id == self.own:
+            return
+
+        i = self._index(node_id)
+        bucket = self.buckets[i]
+
+        if node_id in bucket or len(bucket) < K:
+            bucket[node_id] = addr
+            bucket.move_to_end(node_id)
+            return
+
+        replacements = self.replacements[i]
+        replacements[node_id] = addr
+        replacements.move_to_end(node_id)
+        if len(replacements) > K:
+            replacements.popitem(last=False)
+
+    def failed(self, node_id):
+        i = self._index(node_id)
+        bucket = self.buckets[i]
+
+        if bucket.pop(node_id, None) is not None and self.replacements[i]:
+            node_id, addr = self.replacements[i].popitem()
+            bucket[node_id] = addr
+
+    def closest(self, target, n=K):
+        nodes = [node for bucket in self.buckets for node in bucket.items()]
+        nodes.sort(key=lambda node: distance(node[0], target))
+        return nodes[:n]
+
+
+class Node(DatagramProtocol):
+
+    def __init__(self, addr, node_id=None, loop=None):
+        if loop is None:
+            loop = get_event_loop()
+
+        self.loop = loop
+        self.addr = addr
+        self.id = urandom(32) if node_id is None else node_id
+        self.table = RoutingTable(self.id)
+        self.transport = None
+        self.tasks = []
+        self.secret = urandom(32)
+
+        # club id to the peers announced for it with their expiry, oldest
+        # first
+        self.storage = {}
+
+        self.pending = {}
+        self.txids = count(randrange(1 << 32))
+
+        self.sent = 0
+        self.received = 0
+
+    async def start(self):
+        await self.loop.create_datagram_endpoint(lambda: self, local_addr=self.addr)
+        self.tasks = [ensure_future(self._refresh()), ensure_future(self._sweep())]
+
+    def close(self):
+        for task in self.tasks:
+            task.cancel()
+        self.transport.close()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def _send(self, kind, txid, body, addr):
+        self.sent += 1
+        self.transport.sendto(HEADER.pack(kind, txid, self.id) + body, addr)
+
+    def datagram_received(self, data, addr):
+        try:
+            kind, txid, sender = HEADER.unpack_from(data)
+        except struct_error:
+            return
+
+        self.received += 1
+        self.table.seen(sender, addr)
+        body = memoryview(data)[HEADER.size:]
+
+        if kind in (PONG, NODES, PEERS, ACK):
+            future = self.pending.get(txid)
+            if future is not None and not future.done():
+                future.set_result((kind, bytes(body)))
+            return
+
+        try:
+            self._handle(kind, txid, body, addr)
+        except (ValueError, struct_error):
+            pass
+
+    def _handle(self, kind, txid, body, addr):
+        if kind == PING:
+            self._send(PONG, txid, b'', addr)
+        elif kind == FIND_NODE:
+            target = bytes(body[:32])
+            self._send(NODES, txid, encode_nodes(self.table.closest(target)), addr)
+        elif kind == GET:
+            club_id = bytes(body[:32])
+            peers = self._peers(club_id)
+            nodes = encode_nodes(self.table.closest(club_id))
+            self._send(PEERS, txid, self._token(addr) + encode_peers(peers) + nodes, addr)
+        elif kind == ANNOUNCE:
+            club_id = bytes(body[:32])
+            token = bytes(body[32:32+TOKEN_SIZE])
+            peers, _ = decode_peers(body, 32 + TOKEN_SIZE)
+
+            if token not in (self._token(addr), self._token(addr, 1)):
+                return
+
+            self._store(club_id, addr, peers)
+            self._send(ACK, txid, b'', addr)
+
+    def _token(self, addr, age=0):
+        period = int(self.loop.time() // TOKEN_INTERVAL) - age
+        h = hashlib.sha256(self.secret + pack("!Q", period) + encode_addr(addr))
+        return h.digest()[:TOKEN_SIZE]
+
+    def _store(self, club_id, addr, peers):
+        stored = self.storage.get(club_id)
+        if stored is None:
+            if len(self.storage) >= MAX_SWARMS:
+                return
+            stored = self.storage[club_id] = {}
+
+        # the ports announced, at the address they came from
+        host = inet_aton(addr[0])
+        expiry = self.loop.time() + PEER_TTL
+
+        for peer in peers[:MAX_ADDRS]:
+            peer = host + peer[4:]
+            stored.pop(peer, None)
+            stored[peer] = expiry
+
+        while len(stored) > MAX_PEERS:
+            del stored[next(iter(stored))]
+
+    def _expire(self, club_id):
+        stored = self.storage[club_id]
+        now = self.loop.time()
+
+        while stored:
+            peer = next(iter(stored))
+            if stored[peer] >= now:
+                return
+            del stored[peer]
+
+        del self.storage[club_id]
+
+    def _peers(self, club_id):
+        if club_id not in self.storage:
+            return []
+
+        self._expire(club_id)
+        peers = list(self.storage.get(club_id, ()))
+        if len(peers) > RESPONSE_SIZE:
+            peers = sample(peers, RESPONSE_SIZE)
+
+        return peers
+
+    async def _request(self, kind, body, addr, node_id=None):
+        txid = next(self.txids) & 0xffffffff
+        future = self.pending[txid] = Future()
+        self._send(kind, txid, body, addr)
+
+        try:
+            return await wait_for(future, RPC_TIMEOUT)
+        except TimeoutError:
+            if node_id is not None:
+                self.table.failed(node_id)
+            return None
+        finally:
+            del self.pending[txid]
+
+    async def ping(self, addr):
+        return await self._request(PING, b'', addr) is not None
+
+    async def _query(self, node_id, addr, target, get):
+        reply = await self._request(GET if get else FIND_NODE, target, addr, node_id)
+        if reply is None:
+            return None
+
+        kind, body = reply
+        try:
+            if kind == PEERS:
+                token = body[:TOKEN_SIZE]
+                peers, offset = decode_peers(body, TOKEN_SIZE)
+                return decode_nodes(body, offset), peers, token
+            if kind == NODES:
+                return decode_nodes(body), [], None
+        except (ValueError, struct_error):
+            pass
+
+        return None
+
+    async def lookup(self, target, get=False):
+        # the K closest nodes which answered, and with get the peers
+        # stored on the nodes asked and the tokens of those which answered
+        shortlist = dict(self.table.closest(target))
+        asked = set()
+        answered = set()
+        peers = set()
+        tokens = {}
+
+        def key(node_id):
+            return distance(node_id, target)
+
+        while True:
+            # ask the closest nodes not asked yet, and stop once the K
+            # closest have all been asked
+            closest = sorted(shortlist, key=key)[:K]
+            todo = [n for n in closest if n not in asked][:ALPHA]
+            if not todo:
+                break
+
+            asked.update(todo)
+            replies = await gather(*(
+                self._query(n, shortlist[n], target, get) for n in todo))
+
+            for node_id, reply in zip(todo, replies):
+                if reply is None:
+                    del shortlist[node_id]
+                    continue
+
+                answered.add(node_id)
+                nodes, found, tokens[node_id] = reply
+                peers.update(found)
+
+                for other, addr in nodes:
+                    if other != self.id and other not in asked:
+                        shortlist.setdefault(other, addr)
+
+        nodes = sorted(answered, key=key)[:K]
+        return [(n, shortlist[n], tokens[n]) for n in nodes], list(peers)
+
+    async def bootstrap(self, addrs):
+        await gather(*(self.ping(addr) for addr in addrs))
+        await self.lookup(self.id)
+
+    async def get_peers(self, club_id):
+        _, peers = await self.lookup(club_id, True)
+        return peers
+
+    async def announce(self, club_id, addrs):
+        # stores addrs on the nodes closest to the club, and returns the
+        # peers they had. the nodes store the ports of addrs at the
+        # address this node sends from
+        nodes, peers = await self.lookup(club_id, True)
+        addrs = addrs[:MAX_ADDRS]
+
+        await gather(*(
+            self._request(ANNOUNCE, club_id + token + encode_peers(addrs), addr, node_id)
+            for node_id, addr, token in nodes))
+
+        return peers
+
+    async def _refresh(self):
+        while True:
+            await sleep(REFRESH_INTERVAL)
+            await self.lookup(urandom(32))
+
+    async def _sweep(self):
+        while True:
+            await sleep(SWEEP_INTERVAL)
+
+            for club_id in list(self.storage):
+                self._expire(club_id)
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+
+# disk work runs on a small pool of threads so a slow disk stalls the
+# requests waiting on it, not the event loop. jobs on one file go
+# through a File, which runs them in order. jobs queued while a batch
+# is running make up the next batch, with their data gathered into one
+# write
+
+from asyncio import get_event_loop, ensure_future
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from time import perf_counter
+import os
+
+
+IO_THREADS = 4
+
+
+class Storage:
+
+    def __init__(self, loop=None, threads=IO_THREADS):
+        if loop is None:
+            loop = get_event_loop()
+
+        self.loop = loop
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix='storage')
+
+        # jobs submitted and not finished yet, the most there have been,
+        # and the time jobs took from submission to completion
+        self.queued = 0
+        self.max_queued = 0
+        self.jobs = 0
+        self.elapsed = 0.0
+
+        # bytes handed to File.write and not written yet, and how many
+        # writes they were gathered into
+        self.pending = 0
+        self.written = 0
+        self.writes = 0
+
+    async def run(self, f, *args):
+        self.queued += 1
+        self.max_queued = max(self.max_queued, self.queued)
+        start = perf_counter()
+
+        try:
+            return await self.loop.run_in_executor(self.executor, partial(f, *args))
+        finally:
+            self.queued -= 1
+            self.jobs += 1
+            self.elapsed += perf_counter() - start
+
+    def metrics(self):
+        return {
+            'queued': self.queued,
+            'max_queued': self.max_queued,
+            'jobs': self.jobs,
+            'latency': self.elapsed / self.jobs if self.jobs else 0.0,
+            'pending': self.pending,
+            'written': self.written,
+            'writes': self.writes,
+        }
+
+
+class File:
+
+    # after, an earlier File on the same path, whose jobs all run before
+    # any of this one
+
+    def __init__(self, storage, path, after=None):
+        self.storage = storage
+        self.path = path
+        self.after = after
+        self.f = None
+
+        # callables, or a bytearray of data to append
+        self.jobs = deque()
+        self.task = None
+        self.error = None
+        self.result = None
+
+    def _submit(self, job):
+        self.jobs.append(job)
+
+        if self.task is None:
+            self.task = ensure_future(self._run())
+
+    def _run_batch(self, jobs):
+        for job in jobs:
+            # after an error only closing is still worth doing
+            if self.error is not None and job not in (self._close, self._unlink):
+                continue
+
+            try:
+                if isinstance(job, bytearray):
+                    self.f.write(job)
+                else:
+                    self.result = job()
+            except OSError as e:
+                self.error = e
+
+    async def _run(self):
+        if self.after is not None:
+            await self.after.drain()
+            self.after = None
+
+        while self.jobs:
+            jobs = list(self.jobs)
+            self.jobs.clear()
+
+            n = 0
+            for job in jobs:
+                if isinstance(job, bytearray):
+                    n += len(job)
+                    self.storage.writes += 1
+
+            try:
+                await self.storage.run(self._run_batch, jobs)
+            finally:
+                self.storage.pending -= n
+
+        self.task = None
+
+    async def wait(self):
+        while self.task is not None:
+            await self.task
+
+        if self.error is not None:
+            raise self.error
+
+    async def drain(self):
+        # like wait, without raising the error
+        while self.task is not None:
+            await self.task
+
+    def _open(self):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+        self.f = open(fd, 'r+b')
+
+    def open(self):
+        self._submit(self._open)
+
+    def _truncate(self, size):
+        self.f.seek(size)
+        self.f.truncate()
+
+    def truncate(self, size):
+        self._submit(partial(self._truncate, size))
+
+    def write(self, data):
+        self.storage.pending += len(data)
+        self.storage.written += len(data)
+
+        if self.jobs and isinstance(self.jobs[-1], bytearray):
+            self.jobs[-1] += data
+        else:
+            self._submit(bytearray(data))
+
+    def _pwrite(self, data, offset):
+        os.pwrite(self.f.fileno(), data, offset)
+
+    def pwrite(self, data, offset):
+        self.storage.written += len(data)
+        self.storage.writes += 1
+        self._submit(partial(self._pwrite, data, offset))
+
+    def _unlink(self):
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    def unlink_soon(self):
+        self._submit(self._unlink)
+
+    def _close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+    async def close(self):
+        self._submit(self._close)
+        await self.wait()
+
+    def close_soon(self):
+        self._submit(self._close)
+
+    async def run(self, f, *args):
+        # f runs after the jobs queued so far, returns its result
+        self._submit(partial(f, *args))
+        await self.wait()
+        return self.result
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+from struct import pack, unpack_from
+
+
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+
+def encode_header(n):
+    # a zero 16-bit length escapes to a 32-bit length, which is only
+    # sent to peers that negotiated large frames
+    if n < 0x10000:
+        return pack("!H", n)
+
+    if n > MAX_FRAME_SIZE:
+        raise ValueError("frame too large")
+
+    return pack("!HI", 0, n)
+
+
+class FrameDecoder:
+
+    def __init__(self, callback, max_size=MAX_FRAME_SIZE):
+        self.callback = callback
+        self.max_size = max_size
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        buf = self.buffer
+
+        if not buf:
+            n = self._decode(data)
+            if n < len(data):
+                buf += memoryview(data)[n:]
+            return
+
+        buf += data
+        n = self._decode(buf)
+        del buf[:n]
+
+    def _decode(self, data):
+        # frames are handed to callback as slices of data, which are
+        # only valid until callback returns
+        size = len(data)
+        offset = 0
+
+        with memoryview(data) as view:
+            while size - offset >= 4:
+                n, = unpack_from("!H", data, offset)
+                start = offset + 2
+
+                if n == 0:
+                    if size - offset < 8:
+                        break
+
+                    n, = unpack_from("!I", data, start)
+                    if n > self.max_size:
+                        raise ValueError("frame too large")
+
+                    start += 4
+
+                if n < 2:
+                    raise ValueError("frame too short")
+
+                end = start + n
+                if end > size:
+                    break
+
+                t, = unpack_from("!H", data, start)
+                self.callback(t, view[start+2:end])
+                offset = end
+
+        return offset
@@ -13,8 +13,10 @@ libc = ctypes.CDLL(find_library('c'), use_errno=True)
 IN_NONBLOCK = 0o0004000
 IN_CLOEXEC  = 0o2000000
 
+IN_MODIFY   = 0x00000002
 IN_MOVED_TO = 0x00000080
 IN_CREATE   = 0x00000100
+IN_ISDIR    = 0x40000000
 
 inotify_init1 = libc.inotify_init1
 inotify_init1.argtypes = [ctypes.c_int]
@@ -103,6 +105,11 @@ class Monitor:
     def on_inotify(self):
         size = ctypes.c_int()
         ioctl(self.fd, FIONREAD, size)
+
+        # also called to drain pending events, so there may be none
+        if size.value == 0:
+            return
+
         for e in iter_events(read(self.fd, size.value)):
             callback = self.callbacks[e.wd]
             callback(e)
@@ -0,0 +1,27 @@
+#!/usr/bin/env python3
+
+# digests a peer has announced to us or we have announced to it, so an
+# object is not announced to a peer which knows about it already. only
+# recent ones are kept, in two generations, and the older generation is
+# dropped when the newer one fills up
+
+
+KNOWN_SIZE = 16384
+
+
+class KnownSet:
+
+    def __init__(self, size=KNOWN_SIZE):
+        self.size = size
+        self.current = set()
+        self.previous = set()
+
+    def __contains__(self, sha):
+        return sha in self.current or sha in self.previous
+
+    def add(self, sha):
+        self.current.add(sha)
+
+        if len(self.current) >= self.size:
+            self.previous = self.current
+            self.current = set()
@@ -0,0 +1,417 @@
+#!/usr/bin/env python3
+
+# small objects are appended to pack files instead of being kept as a
+# file each. a pack is a run of records, sha, length and data, so the
+# pack being written can be rescanned after a crash or by another
+# process. a full pack is sealed by writing its index, a fan-out table
+# of counts by first byte followed by the sorted (sha, offset, length)
+# of its records. packs are read through mmap. only the peer appends to
+# packs, objects from smtp.py and large objects stay loose files.
+# objects are committed from storage threads, so the state of the pack
+# being written is kept under a lock.
+#
+# packed objects leave nothing in new/, instead their sha is appended to
+# the journal, which deliver.py reads from the position it saved in the
+# cursor file
+
+from bisect import bisect_left
+from struct import Struct, unpack_from
+from mmap import mmap, ACCESS_READ
+import io
+import os
+import threading
+
+import store
+
+
+# larger objects are fetched by piece and stay loose
+PACK_OBJECT_SIZE = 256 * 1024
+
+PACK_SIZE = 256 * 1024 * 1024
+
+RECORD = Struct("!32sI")
+FANOUT = Struct("!256I")
+INDEX_ENTRY = Struct("!32sQI")
+
+JOURNAL = 'journal'
+CURSOR = 'delivered'
+CURSOR_FORMAT = Struct("!Q")
+
+
+def open_store(path):
+    if os.path.isdir(os.path.join(path, 'packs')):
+        return PackStore(path)
+    return store.Store(path)
+
+
+def encode_index(entries):
+    entries = sorted(entries)
+
+    counts = [0] * 256
+    for sha, _, _ in entries:
+        counts[sha[0]] += 1
+
+    for i in range(1, 256):
+        counts[i] += counts[i - 1]
+
+    return FANOUT.pack(*counts) + b''.join(INDEX_ENTRY.pack(*e) for e in entries)
+
+
+class _Keys:
+
+    # the digests of an index, to bisect on
+
+    def __init__(self, index):
+        self.index = index
+
+    def __len__(self):
+        return (len(self.index) - FANOUT.size) // INDEX_ENTRY.size
+
+    def __getitem__(self, i):
+        offset = FANOUT.size + i * INDEX_ENTRY.size
+        return self.index[offset:offset+32]
+
+
+def search_index(index, sha):
+    lo = unpack_from("!I", index, (sha[0] - 1) * 4)[0] if sha[0] else 0
+    hi, = unpack_from("!I", index, sha[0] * 4)
+
+    keys = _Keys(index)
+    i = bisect_left(keys, sha, lo, hi)
+    if i == hi or keys[i] != sha:
+        return None
+
+    _, offset, length = INDEX_ENTRY.unpack_from(index, FANOUT.size + i * INDEX_ENTRY.size)
+    return offset, length
+
+
+def iter_index(index):
+    for sha, _, _ in INDEX_ENTRY.iter_unpack(memoryview(index)[FANOUT.size:]):
+        yield sha
+
+
+class PackObject(io.RawIOBase):
+
+    # a file over an mmap slice of a pack
+
+    def __init__(self, view):
+        self.view = view
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        data = self.view[self.pos:self.pos+len(b)]
+        n = len(data)
+        b[:n] = data
+        self.pos += n
+        return n
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += len(self.view)
+
+        self.pos = offset
+        return offset
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        if not self.closed:
+            self.view.release()
+        super().close()
+
+
+class PackStore(store.Store):
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.pack_path = os.path.join(path, 'packs')
+        os.makedirs(self.pack_path, exist_ok=True)
+
+        # sealed packs by number, as mmaps of their index
+        self.indexes = {}
+        self.maps = {}
+        self.listed = None
+
+        # the pack being appended to, and what it holds so far
+        self.active = None
+        self.entries = {}
+        self.scanned = 0
+        self.fd = None
+        self.journal_fd = None
+        self.lock = threading.Lock()
+
+        self.refresh()
+
+    def _pack_file(self, n, ext):
+        return os.path.join(self.pack_path, "%08d.%s"%(n, ext))
+
+    def _map(self, path):
+        with open(path, 'rb') as f:
+            return mmap(f.fileno(), 0, access=ACCESS_READ)
+
+    def refresh(self):
+        # packs may have been written by another process
+        mtime = os.stat(self.pack_path).st_mtime_ns
+
+        if mtime != self.listed:
+            self.listed = mtime
+            names = os.listdir(self.pack_path)
+            numbers = sorted(int(n[:-5]) for n in names if n.endswith('.pack'))
+
+            for n in numbers:
+                if n not in self.indexes and "%08d.idx"%(n,) in names:
+                    self.indexes[n] = self._map(self._pack_file(n, 'idx'))
+
+            if numbers and numbers[-1] not in self.indexes and numbers[-1] != self.active:
+                self.active = numbers[-1]
+                self.entries = {}
+                self.scanned = 0
+
+        if self.active is not None:
+            self._scan()
+
+    def _scan(self):
+        with open(self._pack_file(self.active, 'pack'), 'rb') as f:
+            f.seek(self.scanned)
+            data = f.read()
+
+        offset = 0
+        while offset + RECORD.size <= len(data):
+            sha, length = RECORD.unpack_from(data, offset)
+            end = offset + RECORD.size + length
+            if end > len(data):
+                break
+
+            self.entries[sha] = (self.scanned + offset + RECORD.size, length)
+            offset = end
+
+        self.scanned += offset
+
+    def _find(self, sha):
+        entry = self.entries.get(sha)
+        if entry is not None:
+            return (self.active,) + entry
+
+        for n, index in self.indexes.items():
+            entry = search_index(index, sha)
+            if entry is not None:
+                return (n,) + entry
+
+        return None
+
+    def _locate(self, name):
+        sha = bytes.fromhex(name)
+
+        with self.lock:
+            location = self._find(sha)
+            if location is None:
+                self.refresh()
+                location = self._find(sha)
+
+        return location
+
+    def _view(self, name):
+        location = self._locate(name)
+        if location is None:
+            return None
+
+        n, offset, length = location
+
+        m = self.maps.get(n)
+        if m is None or len(m) < offset + length:
+            m = self.maps[n] = self._map(self._pack_file(n, 'pack'))
+
+        return memoryview(m)[offset:offset+length]
+
+    def _open_active(self):
+        if self.active is None:
+            self.active = max(self.indexes, default=-1) + 1
+            self.entries = {}
+            self.scanned = 0
+
+        # drop a record torn by a crash
+        path = self._pack_file(self.active, 'pack')
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+        os.ftruncate(self.fd, self.scanned)
+
+    def _seal(self):
+        data = encode_index((sha, offset, length) for sha, (offset, length) in self.entries.items())
+        path = self._pack_file(self.active, 'idx')
+
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+
+        os.replace(path + '.tmp', path)
+        os.close(self.fd)
+
+        self.indexes[self.active] = self._map(path)
+        self.active += 1
+        self.entries = {}
+        self.scanned = 0
+        self._open_active()
+
+    def append(self, sha, data):
+        with self.lock:
+            if self.fd is None:
+                self._open_active()
+
+            os.write(self.fd, RECORD.pack(sha, len(data)) + data)
+            self.entries[sha] = (self.scanned + RECORD.size, len(data))
+            self.scanned += RECORD.size + len(data)
+
+            if self.scanned >= PACK_SIZE:
+                self._seal()
+
+    def _journal(self, sha):
+        with self.lock:
+            if self.journal_fd is None:
+                path = os.path.join(self.pack_path, JOURNAL)
+                self.journal_fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+
+            os.write(self.journal_fd, sha)
+
+    def add(self, name, data):
+        if len(data) > PACK_OBJECT_SIZE:
+            return super().add(name, data)
+
+        # the record is in the pack before deliver.py hears of it
+        sha = bytes.fromhex(name)
+        self.append(sha, data)
+        self._journal(sha)
+
+    def commit(self, name):
+        # objects resumed from a partial in tmp/
+        path = self.tmp_path(name)
+        if os.stat(path).st_size > PACK_OBJECT_SIZE:
+            return super().commit(name)
+
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        self.add(name, data)
+        os.unlink(path)
+
+    def open(self, sub, name):
+        if sub == 'cur':
+            view = self._view(name)
+            if view is not None:
+                return PackObject(view)
+
+        return super().open(sub, name)
+
+    def exists(self, sub, name):
+        if sub == 'cur' and self._locate(name) is not None:
+            return True
+        return super().exists(sub, name)
+
+    def size(self, name):
+        location = self._locate(name)
+        if location is not None:
+            return location[2]
+        return super().size(name)
+
+    def sizes(self, names):
+        # packs are refreshed once for the lot, not for each loose object
+        with self.lock:
+            self.refresh()
+            locations = [self._find(bytes.fromhex(name)) for name in names]
+
+        loose = iter(super().sizes([
+            name for name, location in zip(names, locations) if location is None]))
+
+        return [
+            next(loose) if location is None else location[2]
+            for location in locations]
+
+    def names(self, sub):
+        yield from super().names(sub)
+
+        if sub == 'cur':
+            for index in list(self.indexes.values()):
+                for sha in iter_index(index):
+                    yield sha.hex()
+
+            for sha in list(self.entries):
+                yield sha.hex()
+
+    def mtime(self, sub):
+        m = super().mtime(sub)
+
+        if sub == 'cur':
+            m = max(m, os.stat(self.pack_path).st_mtime_ns)
+            if self.active is not None:
+                m = max(m, os.stat(self._pack_file(self.active, 'pack')).st_mtime_ns)
+
+        return m
+
+
+class Journal:
+
+    # the packed objects deliver.py has not delivered yet. works before
+    # the store has packs, the journal appears with the first one
+
+    def __init__(self, path):
+        self.path = os.path.join(path, 'packs', JOURNAL)
+        self.cursor_path = os.path.join(path, 'packs', CURSOR)
+        self.fd = None
+        self.position = 0
+
+        try:
+            with open(self.cursor_path, 'rb') as f:
+                self.position, = CURSOR_FORMAT.unpack(f.read(CURSOR_FORMAT.size))
+        except (FileNotFoundError, ValueError):
+            pass
+
+    def read(self):
+        try:
+            with open(self.path, 'rb') as f:
+                f.seek(self.position)
+                data = f.read()
+        except FileNotFoundError:
+            return []
+
+        # an entry still being written is left for next time
+        return [data[i:i+32].hex() for i in range(0, len(data) - 31, 32)]
+
+    def advance(self):
+        # past one object, saved in place so a restart does not deliver
+        # it again
+        if self.fd is None:
+            self.fd = os.open(self.cursor_path, os.O_WRONLY | os.O_CREAT, 0o666)
+
+        self.position += 32
+        os.pwrite(self.fd, CURSOR_FORMAT.pack(self.position), 0)
+
+
+def main(path):
+    # packs the small loose objects of a store, run it while the peer
+    # is stopped
+    s = PackStore(path)
+    packed = 0
+
+    for name in list(store.Store.names(s, 'cur')):
+        loose = s.object_path('cur', name)
+        if os.stat(loose).st_size > PACK_OBJECT_SIZE or s._locate(name) is not None:
+            continue
+
+        with open(loose, 'rb') as f:
+            s.append(bytes.fromhex(name), f.read())
+
+        os.unlink(loose)
+        packed += 1
+
+    print("packed %d objects into %s"%(packed, s.pack_path))
+
+
+if __name__ == '__main__':
+    import sys
+    main(sys.argv[1])
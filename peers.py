@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+
+# keeps the links of an endpoint between a target and a maximum number.
+# peers come from the tracker and from incoming connections. a peer whose
+# link failed is tried again after a delay which doubles with each
+# failure, jittered so peers restarting together do not retry in
+# lockstep. above the maximum the links to the slowest peers are closed,
+# and the fastest peers are tried first when links are missing.
+#
+# linked peers swap samples of the peers they have links to, so peers are
+# found without the tracker
+
+from asyncio import ensure_future, sleep
+from random import sample, uniform
+
+
+TARGET_DEGREE = 8
+MAX_DEGREE = 16
+
+# seconds before the first retry, and the longest wait
+BACKOFF = 1
+MAX_BACKOFF = 300
+
+# links younger than this are not closed for being slow, their
+# throughput is not known yet
+GRACE = 30
+
+# a link which lasted this long clears the failures of its peer
+STABLE = 60
+
+INTERVAL = 5
+
+# peers which are not linked are capped, a full table makes room by
+# dropping the peer which failed most
+MAX_PEERS = 1024
+
+# each link is sent this many peers this often, and lists arriving
+# faster than twice that from one link are ignored
+PEX_INTERVAL = 60
+PEX_SIZE = 16
+
+
+class Peer:
+
+    def __init__(self):
+        self.failures = 0
+        self.retry = 0.0
+        self.throughput = None
+
+
+class PeerManager:
+
+    def __init__(self, endpoint, target=TARGET_DEGREE, maximum=MAX_DEGREE):
+        self.endpoint = endpoint
+        self.loop = endpoint.loop
+        self.target = target
+        self.maximum = maximum
+
+        self.peers = {}
+        self.connecting = set()
+        self.since = {}
+
+        # when peers were last sent to and heard from each link
+        self.sent = {}
+        self.heard = {}
+
+        ensure_future(self._run())
+
+    def add(self, addr):
+        if addr == self.endpoint.get_address():
+            return
+
+        if addr in self.peers:
+            return
+
+        if len(self.peers) >= MAX_PEERS:
+            worst = max(self.peers, key=lambda a: self.peers[a].failures)
+            if not self.peers[worst].failures:
+                return
+            del self.peers[worst]
+
+        self.peers[addr] = Peer()
+        self.maintain()
+
+    def forget(self, addr):
+        # the tracker says the peer is gone
+        if addr not in self.endpoint.connections and addr not in self.connecting:
+            self.peers.pop(addr, None)
+
+    def degree(self):
+        return len(self.connecting.union(self.endpoint.connections))
+
+    def connecting_to(self, addr):
+        self.peers.setdefault(addr, Peer())
+        self.connecting.add(addr)
+
+    def connected(self, conn):
+        self.connecting.discard(conn.addr)
+        self.peers.setdefault(conn.addr, Peer())
+        self.since[conn.addr] = self.loop.time()
+        self.exchange(conn)
+
+    def failed(self, addr):
+        self.connecting.discard(addr)
+        self._backoff(self.peers.setdefault(addr, Peer()))
+        self.maintain()
+
+    def lost(self, conn):
+        addr = conn.addr
+        if addr in self.endpoint.connections:
+            # replaced by a newer link
+            return
+
+        self.connecting.discard(addr)
+        since = self.since.pop(addr, None)
+        self.sent.pop(addr, None)
+        self.heard.pop(addr, None)
+
+        peer = self.peers.setdefault(addr, Peer())
+        if conn.stats.throughput is not None:
+            peer.throughput = conn.stats.throughput
+
+        if since is not None and self.loop.time() - since >= STABLE:
+            peer.failures = 0
+            peer.retry = 0.0
+        else:
+            self._backoff(peer)
+
+        self.maintain()
+
+    def exchange(self, conn):
+        self.sent[conn.addr] = self.loop.time()
+
+        linked = [a for a in self.since if a != conn.addr]
+        if linked:
+            conn.send_peers(sample(linked, min(PEX_SIZE, len(linked))))
+
+    def received(self, conn, addrs):
+        now = self.loop.time()
+        if now - self.heard.get(conn.addr, -PEX_INTERVAL) < PEX_INTERVAL / 2:
+            return
+
+        self.heard[conn.addr] = now
+        for addr in addrs[:PEX_SIZE]:
+            self.add(addr)
+
+    def _backoff(self, peer):
+        delay = min(MAX_BACKOFF, BACKOFF * 2 ** peer.failures)
+        peer.failures += 1
+        peer.retry = self.loop.time() + uniform(delay / 2, delay)
+
+    def maintain(self):
+        now = self.loop.time()
+        connections = self.endpoint.connections
+
+        missing = self.target - self.degree()
+        if missing > 0:
+            candidates = [
+                (addr, peer) for addr, peer in self.peers.items()
+                if addr not in connections and addr not in self.connecting
+                and peer.retry <= now]
+            candidates.sort(key=lambda c: c[1].throughput or 0, reverse=True)
+
+            for addr, _ in candidates[:missing]:
+                self.endpoint.connect(addr)
+
+        excess = len(connections) - self.maximum
+        if excess > 0:
+            old = [
+                conn for addr, conn in connections.items()
+                if addr in self.since and now - self.since[addr] >= GRACE]
+            old.sort(key=lambda c: c.stats.throughput or 0)
+
+            for conn in old[:excess]:
+                conn.transport.close()
+
+    async def _run(self):
+        while True:
+            await sleep(INTERVAL)
+            self.maintain()
+
+            now = self.loop.time()
+            for addr, conn in list(self.endpoint.connections.items()):
+                if addr in self.since and now - self.sent.get(addr, now) >= PEX_INTERVAL:
+                    self.exchange(conn)
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+
+# range based set reconciliation over sha prefixes. a range is
+# (bits, prefix), the digests whose first bits equal prefix; its
+# fingerprint is the count and xor of those digests. peers exchange
+# fingerprints, split ranges that differ, and swap the digests of
+# ranges small enough to list, so traffic grows with the difference
+# between the sets, not their size
+
+from array import array
+from bisect import bisect_left, insort
+from heapq import merge
+from struct import Struct
+
+ENTRY = Struct("!BQI32s")
+RANGE = Struct("!BQ")
+KEY = Struct("!Q24x")
+
+FANOUT_BITS = 4
+MAX_BITS = 64
+
+# ranges are cached up to this depth and updated as objects are added
+CACHE_BITS = 16
+
+# ranges holding at most this many digests are listed instead of split
+THRESHOLD = 32
+
+# digests added since the last merge into the sorted array
+MERGE_SIZE = 4096
+
+# entries that fit in a 16-bit frame
+SUMMARY_SIZE = (0xFFFF - 2) // ENTRY.size
+
+
+def _prefix(sha, bits):
+    return int.from_bytes(sha[:8], 'big') >> (64 - bits)
+
+
+def _xor(data):
+    # xor of the 32-byte records in data, folding halves so the work
+    # stays linear
+    x = int.from_bytes(data, 'big')
+    n = len(data) // 32
+
+    while n > 1:
+        h = n // 2
+        x = (x >> (h * 256)) ^ (x & ((1 << (h * 256)) - 1))
+        n -= h
+
+    return x
+
+
+class ObjectSet:
+
+    # digests are kept sorted in one bytearray, with their first eight
+    # bytes in an array to bisect on. new digests wait in a short sorted
+    # list until MERGE_SIZE of them are merged in a single pass. merging
+    # replaces data instead of changing it, so iterators walk a stable
+    # snapshot
+
+    def __init__(self, shas=()):
+        self.keys = array('Q')
+        self.data = bytearray()
+        self.recent = sorted(set(shas))
+        self.nodes = {}
+        self.version = 0
+        self._merge()
+
+    @classmethod
+    def from_bytes(cls, data):
+        if len(data) % 32:
+            raise ValueError("bad object set")
+
+        objects = cls()
+        objects.data = bytearray(data)
+        objects.keys = array('Q', (k for k, in KEY.iter_unpack(data)))
+        return objects
+
+    def to_bytes(self):
+        self._merge()
+        return self.data
+
+    def copy(self):
+        # shares the sorted data, which merging replaces, so the copy can
+        # be merged on another thread while this one takes new digests
+        objects = ObjectSet()
+        objects.data = self.data
+        objects.keys = self.keys
+        objects.recent = list(self.recent)
+        objects.version = self.version
+        return objects
+
+    def __len__(self):
+        return len(self.keys) + len(self.recent)
+
+    def __iter__(self):
+        data = self.data
+        recent = list(self.recent)
+
+        for i in range(0, len(data), 32):
+            yield bytes(data[i:i+32])
+
+        yield from recent
+
+    def _position(self, sha):
+        key, = KEY.unpack_from(sha)
+        keys = self.keys
+        i = bisect_left(keys, key)
+
+        while i < len(keys) and keys[i] == key and self.data[i*32:i*32+32] < sha:
+            i += 1
+
+        return i
+
+    def __contains__(self, sha):
+        recent = self.recent
+        i = bisect_left(recent, sha)
+        if i < len(recent) and recent[i] == sha:
+            return True
+
+        i = self._position(sha)
+        return i < len(self.keys) and self.data[i*32:i*32+32] == sha
+
+    def add(self, sha):
+        if sha in self:
+            return False
+
+        insort(self.recent, sha)
+        self.version += 1
+        value = int.from_bytes(sha, 'big')
+
+        for bits in range(0, CACHE_BITS + 1, FANOUT_BITS):
+            key = (bits, _prefix(sha, bits))
+            node = self.nodes.get(key)
+            if node is not None:
+                self.nodes[key] = (node[0] + 1, node[1] ^ value)
+
+        if len(self.recent) >= MERGE_SIZE:
+            self._merge()
+
+        return True
+
+    def _merge(self):
+        if not self.recent:
+            return
+
+        new = self.recent
+        self.recent = []
+
+        if not self.keys:
+            self.data = bytearray().join(new)
+            self.keys = array('Q', (k for k, in KEY.iter_unpack(self.data)))
+            return
+
+        data = memoryview(self.data)
+        parts = []
+        keys = array('Q')
+        prev = 0
+
+        for sha in new:
+            i = self._position(sha)
+            parts.append(data[prev*32:i*32])
+            parts.append(sha)
+            keys.extend(self.keys[prev:i])
+            keys.append(KEY.unpack_from(sha)[0])
+            prev = i
+
+        parts.append(data[prev*32:])
+        keys.extend(self.keys[prev:])
+
+        self.data = bytearray().join(parts)
+        self.keys = keys
+
+    def _slice(self, bits, prefix):
+        shift = 64 - bits
+        start = bisect_left(self.keys, prefix << shift)
+
+        hi = (prefix + 1) << shift
+        if hi >> 64:
+            return start, len(self.keys)
+        return start, bisect_left(self.keys, hi, start)
+
+    def _recent_in(self, bits, prefix):
+        shift = 64 - bits
+        lo = prefix << shift
+        if lo >> 64:
+            return []
+
+        recent = self.recent
+        start = bisect_left(recent, lo.to_bytes(8, 'big'))
+
+        hi = (prefix + 1) << shift
+        if hi >> 64:
+            return recent[start:]
+        return recent[start:bisect_left(recent, hi.to_bytes(8, 'big'), start)]
+
+    def items_in(self, bits, prefix):
+        start, end = self._slice(bits, prefix)
+        data = self.data
+        items = [bytes(data[i:i+32]) for i in range(start*32, end*32, 32)]
+
+        recent = self._recent_in(bits, prefix)
+        if recent:
+            items = sorted(items + recent)
+        return items
+
+    def iter_in(self, bits, prefix):
+        # items_in walked lazily, over the data of the moment it was called
+        start, end = self._slice(bits, prefix)
+        data = self.data
+        recent = self._recent_in(bits, prefix)
+
+        stored = (bytes(data[i:i+32]) for i in range(start*32, end*32, 32))
+        return merge(stored, recent) if recent else stored
+
+    def summary(self, bits, prefix):
+        key = (bits, prefix)
+        node = self.nodes.get(key)
+        if node is not None:
+            return node
+
+        start, end = self._slice(bits, prefix)
+        fp = _xor(self.data[start*32:end*32])
+
+        recent = self._recent_in(bits, prefix)
+        for sha in recent:
+            fp ^= int.from_bytes(sha, 'big')
+
+        node = (end - start + len(recent), fp)
+        if bits <= CACHE_BITS:
+            self.nodes[key] = node
+        return node
+
+
+def encode_summary(entries):
+    return b''.join(
+        ENTRY.pack(bits, prefix, count, fp.to_bytes(32, 'big'))
+        for bits, prefix, count, fp in entries)
+
+
+def decode_summary(data):
+    entries = []
+
+    for bits, prefix, count, fp in ENTRY.iter_unpack(data):
+        if bits > MAX_BITS:
+            raise ValueError("bad range")
+        entries.append((bits, prefix, count, int.from_bytes(fp, 'big')))
+
+    return entries
+
+
+def decode_items(data):
+    bits, prefix = RANGE.unpack_from(data)
+    if bits > MAX_BITS or (len(data) - RANGE.size) % 32:
+        raise ValueError("bad range")
+
+    return bits, prefix, {
+        data[i:i+32] for i in range(RANGE.size, len(data), 32)}
+
+
+def compare(objects, entries):
+    # returns the summary entries to send back, and the ranges whose
+    # digests should be listed to the peer
+    summaries = []
+    ranges = []
+
+    for bits, prefix, count, fp in entries:
+        local = objects.summary(bits, prefix)
+        if local == (count, fp):
+            continue
+
+        if local[0] <= THRESHOLD or bits >= MAX_BITS:
+            ranges.append((bits, prefix))
+        elif count <= THRESHOLD:
+            # peer has few, ask it to list them
+            summaries.append((bits, prefix) + local)
+        else:
+            bits += FANOUT_BITS
+            for i in range(1 << FANOUT_BITS):
+                child = (prefix << FANOUT_BITS) | i
+                summaries.append((bits, child) + objects.summary(bits, child))
+
+    return summaries, ranges
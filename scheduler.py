@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+
+from heapq import heappush, heappop, heapreplace
+from itertools import count
+from math import ceil
+
+
+POLICIES = ('rarest', 'newest', 'smallest')
+
+# weight of a new sample in moving averages
+ALPHA = 0.25
+
+# throughput is sampled over busy intervals at least this long, in seconds
+INTERVAL = 0.5
+
+MIN_WINDOW = 2
+
+
+def _average(old, sample):
+    if old is None:
+        return sample
+    return old + ALPHA * (sample - old)
+
+
+class LinkStats:
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.sent = {}
+        self.rtt = None
+        self.throughput = None
+
+        self.mark = None
+        self.received = 0
+
+    def request_sent(self, id):
+        now = self.loop.time()
+        self.sent[id] = now
+
+        if self.mark is None:
+            self.mark = now
+
+    def forget(self, id):
+        self.sent.pop(id, None)
+
+    def response(self, id, n):
+        now = self.loop.time()
+
+        sent = self.sent.pop(id, None)
+        if sent is not None:
+            self.rtt = _average(self.rtt, now - sent)
+
+        if self.mark is None:
+            return
+
+        self.received += n
+        elapsed = now - self.mark
+
+        if elapsed >= INTERVAL:
+            self.throughput = _average(self.throughput, self.received / elapsed)
+            self.mark = now
+            self.received = 0
+
+    def idle(self):
+        # time without requests in flight says nothing about the link
+        self.mark = None
+        self.received = 0
+
+
+class Scheduler:
+
+    def __init__(self, club, policy='rarest'):
+        if policy not in POLICIES:
+            raise ValueError("unknown policy %r"%(policy,))
+
+        self.club = club
+        self.policy = policy
+
+        # per connection heap of (key, seq, sha), stale entries are
+        # skipped or re-keyed when they reach the top
+        self.queues = {}
+        self.seen = {}
+        self.seq = count()
+        self.object_size = None
+
+    def _key(self, sha):
+        if self.policy == 'rarest':
+            return len(self.club.sha_to_conn.get(sha, ()))
+        elif self.policy == 'newest':
+            return -self.seen[sha]
+        else:
+            return self.club.sizes.get(sha, float('inf'))
+
+    def _push(self, conn, sha):
+        heappush(
+            self.queues.setdefault(conn, []),
+            (self._key(sha), self.seen[sha], sha))
+
+    def announced(self, conn, sha):
+        if sha not in self.seen:
+            self.seen[sha] = next(self.seq)
+
+        self._push(conn, sha)
+
+    def released(self, sha):
+        # the request failed, offer the object to every holder again
+        for conn in self.club.sha_to_conn.get(sha, ()):
+            self._push(conn, sha)
+
+    def next(self, conn):
+        queue = self.queues.get(conn)
+
+        while queue:
+            key, seq, sha = queue[0]
+
+            if sha in self.club.requesting or sha not in self.club.conn_to_sha.get(conn, ()):
+                heappop(queue)
+                continue
+
+            current = self._key(sha)
+            if current != key:
+                heapreplace(queue, (current, seq, sha))
+                continue
+
+            heappop(queue)
+            return sha
+
+        return None
+
+    def finished(self, sha, size):
+        self.seen.pop(sha, None)
+        self.object_size = _average(self.object_size, size)
+
+    def connection_lost(self, conn):
+        self.queues.pop(conn, None)
+
+    def sources(self, sha):
+        conns = self.club.sha_to_conn.get(sha, ())
+        return sorted(conns, key=lambda c: c.stats.throughput or 0, reverse=True)
+
+    def window(self, conn):
+        # enough requests to cover the bandwidth delay product of the
+        # link, so slow links hold few objects and fast ones many
+        stats = conn.stats
+
+        if stats.rtt is None or stats.throughput is None or not self.object_size:
+            return conn.window
+
+        bdp = stats.throughput * stats.rtt
+        window = max(MIN_WINDOW, ceil(bdp / self.object_size) + MIN_WINDOW)
+        return min(conn.window, window)
@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+
+# objects are kept in cur/ and new/ under their hex sha256. a flat store
+# keeps them directly in those directories, a sharded one fans them out
+# by prefix, cur/ab/cd/<sha> at depth 2. the depth is read from the
+# layout file at the root of the store, a missing file means flat.
+# after a migration the file also holds the depth it started from, until
+# the migration is finished. tmp/ only holds objects being written and
+# is always flat
+
+from asyncio import get_event_loop, ensure_future, sleep
+from errno import ENOSPC
+from functools import partial
+import os
+import time
+
+import inotify
+
+
+LAYOUT = 'layout'
+
+# hex digits per level
+WIDTH = 2
+
+# 256 directories under cur/ and new/, each needing an inotify watch
+DEFAULT_DEPTH = 1
+
+# seconds between rescans of the directories inotify has no watch left
+# for, see fs.inotify.max_user_watches
+RESCAN_INTERVAL = 10
+
+# a directory changed this recently is listed again on the next rescan,
+# as another change within the same tick leaves its mtime alone
+MTIME_SLACK = 2 * 10**9
+
+
+def layout_stat(path):
+    try:
+        st = os.stat(os.path.join(path, LAYOUT))
+    except FileNotFoundError:
+        return None
+    return st.st_ino, st.st_mtime_ns
+
+
+def read_layout(path):
+    try:
+        with open(os.path.join(path, LAYOUT)) as f:
+            depths = [int(d) for d in f.read().split()]
+    except FileNotFoundError:
+        return 0, None
+
+    if len(depths) == 1:
+        return depths[0], None
+    return tuple(depths)
+
+
+def write_layout(path, depth, previous=None):
+    tmp = os.path.join(path, LAYOUT + '.tmp')
+
+    with open(tmp, 'w') as f:
+        if previous is None:
+            f.write("%d\n"%(depth,))
+        else:
+            f.write("%d %d\n"%(depth, previous))
+
+    os.replace(tmp, os.path.join(path, LAYOUT))
+
+
+class Store:
+
+    def __init__(self, path):
+        self.path = path
+
+        os.makedirs(os.path.join(path, 'cur'), exist_ok=True)
+        os.makedirs(os.path.join(path, 'new'), exist_ok=True)
+        os.makedirs(os.path.join(path, 'tmp'), exist_ok=True)
+
+        self._read_layout()
+
+        # with directories left to rescans, when the last one started
+        self.rescanned = None
+
+    def _read_layout(self):
+        self.layout = layout_stat(self.path)
+        self.depth, self.previous = read_layout(self.path)
+
+    def _path(self, sub, name, depth):
+        shards = [name[i*WIDTH:(i+1)*WIDTH] for i in range(depth)]
+        return os.path.join(self.path, sub, *shards, name)
+
+    def object_path(self, sub, name):
+        return self._path(sub, name, self.depth)
+
+    def tmp_path(self, name):
+        return os.path.join(self.path, 'tmp', name)
+
+    def _retry(self, f, sub, name):
+        tried = self.depth
+
+        try:
+            return f(self.object_path(sub, name))
+        except FileNotFoundError:
+            # another process may be migrating the store
+            self._read_layout()
+
+        for depth in (self.depth, self.previous):
+            if depth is not None and depth != tried:
+                try:
+                    return f(self._path(sub, name, depth))
+                except FileNotFoundError:
+                    pass
+
+        raise FileNotFoundError(self.object_path(sub, name))
+
+    def open(self, sub, name):
+        return self._retry(partial(open, mode='rb'), sub, name)
+
+    def stat(self, sub, name):
+        return self._retry(os.stat, sub, name)
+
+    def exists(self, sub, name):
+        try:
+            self.stat(sub, name)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def size(self, name):
+        return self.stat('cur', name).st_size
+
+    def sizes(self, names):
+        # 0 for objects gone since
+        sizes = []
+        for name in names:
+            try:
+                sizes.append(self.size(name))
+            except FileNotFoundError:
+                sizes.append(0)
+
+        return sizes
+
+    def _place(self, f, src, sub, name):
+        # written under the layout a migration switched to, even if it
+        # ran after this store was opened
+        if layout_stat(self.path) != self.layout:
+            self._read_layout()
+
+        dst = self.object_path(sub, name)
+        if self.depth:
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+        f(src, dst)
+
+    def move(self, src, sub, name):
+        self._place(os.rename, src, sub, name)
+
+    def link(self, src, sub, name):
+        self._place(os.link, src, sub, name)
+
+    def commit(self, name):
+        # from tmp/ into new/, then linked into cur/
+        self.move(self.tmp_path(name), 'new', name)
+        self.link(self.object_path('new', name), 'cur', name)
+
+    def add(self, name, data):
+        # an object received whole into memory
+        with open(self.tmp_path(name), 'wb') as f:
+            f.write(data)
+
+        self.commit(name)
+
+    def names(self, sub):
+        for _, _, files in os.walk(os.path.join(self.path, sub)):
+            yield from files
+
+    def mtime(self, sub):
+        # a new object moves the mtime of its directory forward, so the
+        # latest mtime in the tree changes whenever an object is added
+        def latest(path, level):
+            m = os.stat(path).st_mtime_ns
+
+            if level < self.depth:
+                with os.scandir(path) as it:
+                    for entry in it:
+                        if entry.is_dir():
+                            m = max(m, latest(entry.path, level + 1))
+
+            return m
+
+        return latest(os.path.join(self.path, sub), 0)
+
+    def watch(self, monitor, sub, mask, callback):
+        # every directory in the tree is watched, including those created
+        # later, so objects are seen whatever the layout. once there are
+        # no inotify watches left, the directories not watched are
+        # rescanned every RESCAN_INTERVAL instead
+        polled = {}
+        rescanning = []
+
+        def on_event(top, e):
+            if e.mask & inotify.IN_ISDIR:
+                if e.mask & inotify.IN_CREATE:
+                    add(os.path.join(top, e.name), True)
+            elif e.mask & mask:
+                callback(e)
+
+        def add(top, new):
+            try:
+                monitor.register(top, mask | inotify.IN_CREATE, partial(on_event, top))
+                watched = True
+            except OSError as e:
+                if e.errno != ENOSPC:
+                    raise
+                watched = False
+
+            files = set()
+            dirs = set()
+
+            # entries created in a new directory before it was watched
+            with os.scandir(top) as it:
+                for entry in it:
+                    if entry.is_dir():
+                        dirs.add(entry.name)
+                        add(entry.path, new)
+                    else:
+                        files.add(entry.name)
+                        if new:
+                            callback(inotify.Event(None, mask, 0, entry.name))
+
+            if not watched:
+                if not rescanning:
+                    rescanning.append(ensure_future(rescan()))
+                polled[top] = [None, files, dirs]
+
+        async def rescan():
+            loop = get_event_loop()
+
+            while True:
+                await sleep(RESCAN_INTERVAL)
+
+                started = time.time_ns()
+                dirs = [(top, state[0]) for top, state in polled.items()]
+                changed = await loop.run_in_executor(None, _list_changed, dirs)
+
+                for top, mtime, files, subdirs in changed:
+                    if files is None:
+                        del polled[top]
+                        continue
+
+                    state = polled[top]
+                    for name in files - state[1]:
+                        callback(inotify.Event(None, mask, 0, name))
+                    for name in subdirs - state[2]:
+                        add(os.path.join(top, name), True)
+                    polled[top] = [mtime, files, subdirs]
+
+                self.rescanned = started
+
+        add(os.path.join(self.path, sub), False)
+
+
+def _list_changed(dirs):
+    # the entries of each directory whose mtime moved, None for those
+    # gone. a directory changed just now gets no mtime, so it is listed
+    # again next time
+    recent = time.time_ns() - MTIME_SLACK
+    changed = []
+
+    for top, mtime in dirs:
+        try:
+            m = os.stat(top).st_mtime_ns
+            if m == mtime:
+                continue
+
+            files = set()
+            subdirs = set()
+            with os.scandir(top) as it:
+                for entry in it:
+                    (subdirs if entry.is_dir() else files).add(entry.name)
+        except FileNotFoundError:
+            changed.append((top, None, None, None))
+            continue
+
+        changed.append((top, m if m < recent else None, files, subdirs))
+
+    return changed
+
+
+def _move_objects(store):
+    moved = 0
+
+    for sub in ('cur', 'new'):
+        root = os.path.join(store.path, sub)
+
+        for top, _, files in os.walk(root, topdown=False):
+            for name in files:
+                src = os.path.join(top, name)
+                if src == store.object_path(sub, name):
+                    continue
+
+                try:
+                    store.link(src, sub, name)
+                except FileExistsError:
+                    pass
+
+                try:
+                    os.unlink(src)
+                except FileNotFoundError:
+                    pass
+
+                moved += 1
+
+            if top != root:
+                try:
+                    os.rmdir(top)
+                except OSError:
+                    pass
+
+    return moved
+
+
+def migrate(path, depth=DEFAULT_DEPTH):
+    # safe while peers are running. the new layout is recorded first
+    # with the old depth, so processes missing an object under one
+    # layout look under the other, and processes check the layout before
+    # placing an object. objects are linked into place before the old
+    # name is removed. a process which checked just before the switch
+    # may still place an object under the old layout, so the old depth
+    # stays recorded. migrating again to the same depth moves what was
+    # left behind and forgets the old depth, which is safe once every
+    # process running during the first pass has placed an object since
+    # or been restarted
+    store = Store(path)
+
+    if store.depth == depth and store.previous is not None:
+        moved = _move_objects(store)
+        write_layout(path, depth)
+        return moved
+
+    previous = store.depth if store.previous is None else store.previous
+
+    write_layout(path, depth, previous)
+    store._read_layout()
+
+    return _move_objects(store) + _move_objects(store)
+
+
+def main(path, depth=DEFAULT_DEPTH):
+    moved = migrate(path, depth)
+    previous = read_layout(path)[1]
+
+    if previous is None:
+        print("moved %d objects, depth %d"%(moved, depth))
+    else:
+        print("moved %d objects, depth %d, run again to forget depth %d"%(moved, depth, previous))
+
+
+if __name__ == '__main__':
+    import sys
+    main(sys.argv[1], *(int(a) for a in sys.argv[2:]))
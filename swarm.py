@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+
+# objects larger than a piece are fetched as a manifest listing the sha256
+# of every piece, then piece by piece from every peer which has the object
+
+from asyncio import ensure_future
+from collections import deque
+from struct import Struct
+import hashlib
+import os
+
+
+PIECE_SIZE = 256 * 1024
+
+# endgame starts when this few pieces are left, and each of them may
+# then be requested from this many peers at once
+ENDGAME_PIECES = 8
+ENDGAME_COPIES = 2
+
+MANIFEST = Struct("!QI")
+
+
+def piece_count(size):
+    return (size + PIECE_SIZE - 1) // PIECE_SIZE
+
+
+def piece_range(size, index):
+    offset = index * PIECE_SIZE
+    return offset, min(PIECE_SIZE, size - offset)
+
+
+def check_pieces(f, size, hashes):
+    # the pieces an earlier attempt did not leave in the file, which is
+    # then sized for the object. reads and hashes the whole partial, so
+    # it runs on a storage thread
+    partial = os.fstat(f.fileno()).st_size
+    missing = []
+
+    for index, digest in enumerate(hashes):
+        offset, length = piece_range(size, index)
+
+        if offset + length <= partial:
+            data = os.pread(f.fileno(), length, offset)
+            if hashlib.sha256(data).digest() == digest:
+                continue
+
+        missing.append(index)
+
+    f.truncate(size)
+    return missing
+
+
+def _digest(data):
+    return hashlib.sha256(data).digest()
+
+
+def compute_manifest(f):
+    size = 0
+    hashes = []
+
+    while True:
+        data = f.read(PIECE_SIZE)
+        if not data:
+            return size, hashes
+
+        size += len(data)
+        hashes.append(hashlib.sha256(data).digest())
+
+
+def encode_manifest(size, hashes):
+    return MANIFEST.pack(size, PIECE_SIZE) + b''.join(hashes)
+
+
+def decode_manifest(data):
+    size, piece_size = MANIFEST.unpack_from(data)
+    n = piece_count(size)
+
+    if piece_size != PIECE_SIZE or size <= PIECE_SIZE or len(data) != MANIFEST.size + n * 32:
+        raise ValueError("bad manifest")
+
+    return size, [data[i:i+32] for i in range(MANIFEST.size, len(data), 32)]
+
+
+class PieceRequest:
+
+    def __init__(self, download, conn, index, id):
+        self.download = download
+        self.conn = conn
+        self.index = index
+        self.id = id
+        self.offset, self.length = download.piece_range(index)
+        self.buffer = bytearray()
+
+        # received whole and being checked, or no longer wanted
+        self.received = False
+        self.cancelled = False
+
+    def write(self, data):
+        if len(self.buffer) + len(data) <= self.length:
+            self.buffer += data
+
+    def finish(self):
+        del self.conn.requests[self.id]
+        self.received = True
+        ensure_future(self._check())
+
+    async def _check(self):
+        # a whole piece is hashed on a storage thread, it stays in flight
+        # meanwhile
+        digest = await self.download.club.storage.run(_digest, self.buffer)
+        if not self.cancelled:
+            self.download.piece_finished(self, digest == self.download.hashes[self.index])
+
+    def fail(self, code=None):
+        del self.conn.requests[self.id]
+        self.download.piece_failed(self)
+
+    def manifest(self, data):
+        self.fail()
+
+    def cancel(self):
+        self.cancelled = True
+
+        if not self.received:
+            del self.conn.requests[self.id]
+            self.conn.cancel_request(self.id)
+
+
+class Download:
+
+    # file is the diskio.File the object is written through, missing the
+    # pieces check_pieces found it still needs
+
+    def __init__(self, club, sha, size, hashes, file, missing, origin):
+        self.club = club
+        self.sha = sha
+        self.size = size
+        self.hashes = hashes
+        self.file = file
+        self.origin = origin
+
+        self.missing = deque(missing)
+        self.inflight = {}
+        self.remaining = len(missing)
+        self.bad = set()
+
+    def piece_range(self, index):
+        return piece_range(self.size, index)
+
+    def _next_piece(self, conn):
+        if self.missing:
+            return self.missing.popleft()
+
+        if self.remaining > ENDGAME_PIECES:
+            return None
+
+        # endgame, every piece left is in flight, race a slow peer for it
+        for index, requests in self.inflight.items():
+            if len(requests) < ENDGAME_COPIES and all(r.conn is not conn for r in requests):
+                return index
+
+        return None
+
+    def fill(self, conn):
+        while conn not in self.bad and conn.can_request_piece():
+            index = self._next_piece(conn)
+            if index is None:
+                return
+
+            request = conn.request_piece(self, index)
+            self.inflight.setdefault(index, []).append(request)
+
+    def _release(self, request):
+        requests = self.inflight[request.index]
+        requests.remove(request)
+
+        if not requests:
+            del self.inflight[request.index]
+            self.missing.appendleft(request.index)
+
+    def piece_finished(self, request, ok):
+        if not ok:
+            self.bad.add(request.conn)
+            self._release(request)
+        else:
+            self.file.pwrite(request.buffer, request.offset)
+            self.remaining -= 1
+
+            for other in self.inflight.pop(request.index):
+                if other is not request:
+                    other.cancel()
+
+        self.club.piece_finished(self, request.conn)
+
+    def piece_failed(self, request):
+        self._release(request)
+        self.club.piece_finished(self, request.conn)
+
+    def cancel(self):
+        for requests in self.inflight.values():
+            for request in requests:
+                request.cancel()
+
+        self.inflight.clear()
@@ -1,39 +1,496 @@
 #!/usr/bin/env python3
 
-from socket import (
-    socket, AF_INET, SOCK_STREAM,
-    SOL_SOCKET, SO_REUSEADDR, SOMAXCONN)
+# a peer announces its addresses and gets back a random sample of the
+# other peers. peers which have not announced within the ttl are dropped,
+# oldest first, so the table only holds live peers.
+#
+# each club is a separate swarm with its own table. an announce starting
+# with 0xffff lists the clubs of a process, each as a 32 byte id and its
+# addresses, and the answer holds a sample for each of them. the older
+# announce, a bare list of addresses, goes to the swarm with the all zero
+# id.
+#
+# an announce starting with 0xfffe opens a session instead. the
+# connection stays open, the client repeats its announce as a keepalive,
+# and the tracker sends it a sample of peers and then changes to it as
+# deltas: a club id, JOIN or LEAVE, and a list of addresses. a session
+# is told about at most response-size peers per club, and is given
+# another one when one of them leaves. every keepalive is answered, with
+# an empty JOIN when there is nothing else, so the client can tell a dead
+# session from a quiet one. the addresses of a session are dropped as
+# soon as it closes.
+#
+# trackers from before clubs read either announce as a count of
+# addresses and wait for them, so the tracker has to be upgraded before
+# its peers
 
-from struct import pack, unpack
+from asyncio import get_event_loop, sleep, ensure_future, Protocol
+from collections import OrderedDict
+from random import sample
+from struct import Struct, pack, unpack_from
+import sys
 
 
-def main(port):
-    peers = ()
+TTL = 60
 
-    s = socket(AF_INET, SOCK_STREAM)
-    s.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
-    s.bind(('', port))
-    s.listen(SOMAXCONN)
+RESPONSE_SIZE = 50
 
-    while True:
-        conn, addr = s.accept()
-        n, = unpack("!H", conn.recv(2))
+# most addresses one peer may announce per club, and most clubs
+MAX_ADDRS = 16
+MAX_CLUBS = 256
 
-        new_peers = peers
+# a full swarm drops its oldest peer for a new one. announces for new
+# swarms are ignored while there are too many
+MAX_PEERS = 4096
+MAX_SWARMS = 16384
 
-        for _ in range(n):
-            peer = conn.recv(6)
-            if peer not in new_peers:
-                new_peers += (peer,)
+# seconds a client has to send its announce
+READ_TIMEOUT = 10
 
-        conn.send(pack("!H", len(peers)))
+# how often swarms nobody announces to are checked for expired peers
+SWEEP_INTERVAL = 10
 
-        for peer in peers:
-            conn.send(peer)
+MULTI = b'\xff\xff'
+SESSION = b'\xff\xfe'
+DEFAULT_CLUB = bytes(32)
 
-        peers = new_peers[:10]
+JOIN = 1
+LEAVE = 2
+DELTA = Struct("!32sBH")
+
+
+def encode_announce(clubs, magic=MULTI):
+    # clubs is a list of (club id, addresses)
+    parts = [magic, pack("!H", len(clubs))]
+
+    for club_id, addrs in clubs:
+        parts += [club_id, pack("!H", len(addrs))]
+        parts += addrs
+
+    return b''.join(parts)
+
+
+def _decode_addrs(data, offset):
+    if len(data) < offset + 2:
+        return None, offset
+
+    n, = unpack_from("!H", data, offset)
+    if n > MAX_ADDRS:
+        raise ValueError("too many addresses")
+
+    offset += 2
+    end = offset + 6 * n
+    if len(data) < end:
+        return None, offset
+
+    return [data[i:i+6] for i in range(offset, end, 6)], end
+
+
+def decode_announce(data):
+    # the magic, None for the older announce, the clubs, and the length.
+    # None until the whole announce has arrived
+    if len(data) < 2:
+        return None
+
+    magic = data[:2]
+    if magic not in (MULTI, SESSION):
+        addrs, end = _decode_addrs(data, 0)
+        return None if addrs is None else (None, [(DEFAULT_CLUB, addrs)], end)
+
+    if len(data) < 4:
+        return None
+
+    n, = unpack_from("!H", data, 2)
+    if n > MAX_CLUBS:
+        raise ValueError("too many clubs")
+
+    clubs = []
+    offset = 4
+    for _ in range(n):
+        if len(data) < offset + 32:
+            return None
+
+        club_id = data[offset:offset+32]
+        addrs, offset = _decode_addrs(data, offset + 32)
+        if addrs is None:
+            return None
+
+        clubs.append((club_id, addrs))
+
+    return magic, clubs, offset
+
+
+def decode_response(data):
+    # the answer to encode_announce, as a dict of club id to peers
+    n, = unpack_from("!H", data, 0)
+    offset = 2
+    clubs = {}
+
+    for _ in range(n):
+        club_id = bytes(data[offset:offset+32])
+        k, = unpack_from("!H", data, offset + 32)
+        offset += 34
+        clubs[club_id] = [bytes(data[i:i+6]) for i in range(offset, offset + 6 * k, 6)]
+        offset += 6 * k
+
+    if offset != len(data):
+        raise ValueError("bad response")
+
+    return clubs
+
+
+def encode_delta(club_id, kind, addrs):
+    return DELTA.pack(club_id, kind, len(addrs)) + b''.join(addrs)
+
+
+async def read_delta(reader):
+    club_id, kind, n = DELTA.unpack(await reader.readexactly(DELTA.size))
+    data = await reader.readexactly(6 * n)
+    return club_id, kind, [data[i:i+6] for i in range(0, len(data), 6)]
+
+
+class PeerTable:
+
+    def __init__(self, ttl=TTL, max_peers=MAX_PEERS):
+        self.ttl = ttl
+        self.max_peers = max_peers
+
+        # last announce of each address, oldest first
+        self.seen = OrderedDict()
+
+        # the same addresses in a list, to sample from
+        self.addrs = []
+        self.index = {}
+
+    def __len__(self):
+        return len(self.addrs)
+
+    def __contains__(self, addr):
+        return addr in self.seen
+
+    def add(self, addr, now):
+        # returns the address dropped to make room, if any
+        dropped = None
+
+        if addr in self.seen:
+            self.seen.move_to_end(addr)
+        else:
+            if len(self.addrs) >= self.max_peers:
+                dropped = next(iter(self.seen))
+                self.remove(dropped)
+
+            self.index[addr] = len(self.addrs)
+            self.addrs.append(addr)
+
+        self.seen[addr] = now
+        return dropped
+
+    def remove(self, addr):
+        del self.seen[addr]
+        self._remove(addr)
+
+    def _remove(self, addr):
+        # the last address takes the place of the removed one
+        i = self.index.pop(addr)
+        last = self.addrs.pop()
+        if last != addr:
+            self.addrs[i] = last
+            self.index[last] = i
+
+    def expire(self, now):
+        seen = self.seen
+        expired = []
+
+        while seen:
+            addr = next(iter(seen))
+            if now - seen[addr] < self.ttl:
+                break
+
+            self.remove(addr)
+            expired.append(addr)
+
+        return expired
+
+    def sample(self, n, exclude=()):
+        k = min(n + len(exclude), len(self.addrs))
+        return [a for a in sample(self.addrs, k) if a not in exclude][:n]
+
+    def memory(self):
+        # bytes held by the table, the addresses themselves included
+        n = len(self.addrs)
+        addr = sys.getsizeof(self.addrs[0]) if n else 0
+
+        return (
+            sys.getsizeof(self.seen) + sys.getsizeof(self.addrs) +
+            sys.getsizeof(self.index) + n * addr)
+
+
+class AnnounceProtocol(Protocol):
+
+    def __init__(self, tracker):
+        self.tracker = tracker
+        self.buffer = b''
+        self.transport = None
+        self.timeout = None
+
+        # for a session, the addresses it announced and the peers it was
+        # told about, by club, and deltas not sent yet
+        self.clubs = None
+        self.known = {}
+        self.pending = []
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.timeout = self.tracker.loop.call_later(READ_TIMEOUT, transport.close)
+
+    def connection_lost(self, exc):
+        self.timeout.cancel()
+
+        if self.clubs is not None:
+            self.tracker.close_session(self)
+
+    def data_received(self, data):
+        # anything after an announce is ignored, unless in a session
+        if self.transport.is_closing():
+            return
+
+        self.buffer += data
+
+        while True:
+            try:
+                announce = decode_announce(self.buffer)
+            except ValueError:
+                self.transport.close()
+                return
+
+            if announce is None:
+                return
+
+            magic, clubs, end = announce
+            self.buffer = self.buffer[end:]
+
+            if magic != SESSION:
+                self.transport.write(self.tracker.announce(magic == MULTI, clubs))
+                self.transport.close()
+                return
+
+            # a session lives as long as it keeps announcing
+            self.timeout.cancel()
+            self.timeout = self.tracker.loop.call_later(
+                self.tracker.ttl, self.transport.close)
+            self.tracker.session(self, clubs)
+
+    def send(self, club_id, kind, addrs):
+        if not self.pending:
+            self.tracker.loop.call_soon(self._flush)
+
+        self.pending.append(encode_delta(club_id, kind, addrs))
+
+    def _flush(self):
+        if not self.transport.is_closing():
+            self.transport.writelines(self.pending)
+
+        self.pending = []
+
+
+class Tracker:
+
+    def __init__(self, ttl=TTL, response_size=RESPONSE_SIZE, loop=None,
+                 max_peers=MAX_PEERS, max_swarms=MAX_SWARMS):
+        if loop is None:
+            loop = get_event_loop()
+
+        self.loop = loop
+        self.ttl = ttl
+        self.response_size = response_size
+        self.max_peers = max_peers
+        self.max_swarms = max_swarms
+
+        self.swarms = {}
+        self.announces = 0
+        self.refused = 0
+
+        # sessions by club, and the sessions told about each peer
+        self.sessions = {}
+        self.watchers = {}
+
+        ensure_future(self._sweep())
+
+    def _table(self, club_id):
+        table = self.swarms.get(club_id)
+
+        if table is None:
+            if len(self.swarms) >= self.max_swarms:
+                self.refused += 1
+                return None
+
+            table = self.swarms[club_id] = PeerTable(self.ttl, self.max_peers)
+
+        return table
+
+    def _add(self, club_id, table, addrs, now):
+        for addr in addrs:
+            new = addr not in table
+            dropped = table.add(addr, now)
+
+            if dropped is not None:
+                self._left(club_id, dropped)
+            if new:
+                self._joined(club_id, addr)
+
+    def _expire(self, club_id, table, now):
+        for addr in table.expire(now):
+            self._left(club_id, addr)
+
+    def _swarm_peers(self, club_id, addrs, now):
+        table = self._table(club_id)
+        if table is None:
+            return []
+
+        self._expire(club_id, table, now)
+        peers = table.sample(self.response_size, addrs)
+        self._add(club_id, table, addrs, now)
+        return peers
+
+    def _tell(self, s, club_id, addrs):
+        known = s.known[club_id]
+        for addr in addrs:
+            known.add(addr)
+            self.watchers.setdefault((club_id, addr), set()).add(s)
+
+        s.send(club_id, JOIN, addrs)
+
+    def _fill(self, s, club_id):
+        table = self.swarms.get(club_id)
+        known = s.known[club_id]
+        n = self.response_size - len(known)
+
+        if table is not None and n > 0:
+            peers = table.sample(n, known | s.clubs[club_id])
+            if peers:
+                self._tell(s, club_id, peers)
+
+    def _joined(self, club_id, addr):
+        for s in self.sessions.get(club_id, ()):
+            if len(s.known[club_id]) < self.response_size and addr not in s.clubs[club_id]:
+                self._tell(s, club_id, [addr])
+
+    def _left(self, club_id, addr):
+        for s in self.watchers.pop((club_id, addr), ()):
+            s.known[club_id].discard(addr)
+            s.send(club_id, LEAVE, [addr])
+            self._fill(s, club_id)
+
+    def session(self, s, clubs):
+        now = self.loop.time()
+        self.announces += 1
+
+        keepalive = s.clubs is not None
+        if not keepalive:
+            s.clubs = {}
+
+        for club_id, addrs in clubs:
+            table = self._table(club_id)
+            if table is None:
+                continue
+
+            addrs = set(addrs)
+            old = s.clubs.get(club_id)
+            s.clubs[club_id] = addrs
+
+            if old is None:
+                s.known[club_id] = set()
+                self.sessions.setdefault(club_id, set()).add(s)
+            else:
+                for addr in old - addrs:
+                    if addr in table:
+                        table.remove(addr)
+                        self._left(club_id, addr)
+
+            self._expire(club_id, table, now)
+            self._add(club_id, table, addrs, now)
+            self._fill(s, club_id)
+
+            # an empty delta lets the client know the session is up
+            if old is None and not s.known[club_id]:
+                s.send(club_id, JOIN, [])
+
+        if keepalive and clubs and not s.pending:
+            s.send(clubs[0][0], JOIN, [])
+
+    def close_session(self, s):
+        for club_id, addrs in s.clubs.items():
+            self.sessions[club_id].discard(s)
+            if not self.sessions[club_id]:
+                del self.sessions[club_id]
+
+            for addr in s.known[club_id]:
+                watchers = self.watchers.get((club_id, addr))
+                if watchers is not None:
+                    watchers.discard(s)
+                    if not watchers:
+                        del self.watchers[(club_id, addr)]
+
+            table = self.swarms.get(club_id)
+            for addr in addrs:
+                if table is not None and addr in table:
+                    table.remove(addr)
+                    self._left(club_id, addr)
+
+    def announce(self, multi, clubs):
+        now = self.loop.time()
+        self.announces += 1
+
+        if not multi:
+            (club_id, addrs), = clubs
+            peers = self._swarm_peers(club_id, addrs, now)
+            return pack("!H", len(peers)) + b''.join(peers)
+
+        parts = [pack("!H", len(clubs))]
+        for club_id, addrs in clubs:
+            peers = self._swarm_peers(club_id, addrs, now)
+            parts += [club_id, pack("!H", len(peers))]
+            parts += peers
+
+        return b''.join(parts)
+
+    async def _sweep(self):
+        while True:
+            await sleep(SWEEP_INTERVAL)
+
+            now = self.loop.time()
+            for club_id, table in list(self.swarms.items()):
+                self._expire(club_id, table, now)
+                if not table and club_id not in self.sessions:
+                    del self.swarms[club_id]
+
+    def metrics(self):
+        return {
+            'swarms': len(self.swarms),
+            'peers': sum(len(t) for t in self.swarms.values()),
+            'memory': sys.getsizeof(self.swarms) + sum(
+                t.memory() for t in self.swarms.values()),
+            'sessions': sum(len(s) for s in self.sessions.values()),
+            'announces': self.announces,
+            'refused': self.refused,
+        }
+
+    async def serve(self, host, port):
+        return await self.loop.create_server(
+            lambda: AnnounceProtocol(self), host, port,
+            backlog=4096, reuse_address=True)
+
+
+def main(port, ttl=TTL, response_size=RESPONSE_SIZE):
+    loop = get_event_loop()
+    tracker = Tracker(ttl, response_size, loop)
+    loop.run_until_complete(tracker.serve('', port))
+
+    try:
+        loop.run_forever()
+    finally:
+        loop.close()
 
 
 if __name__ == '__main__':
-    import sys
-    main(int(sys.argv[1]))
+    main(*(int(a) for a in sys.argv[1:]))